@@ -0,0 +1,194 @@
+"""
+Scaling benchmark for ``cs336_basics.train_bpe``.
+
+Runs ``train_bpe`` over a matrix of corpora (the test fixtures plus synthetic corpora scaled 1x-64x),
+vocab sizes and worker counts. Every case runs in a fresh process so peak memory is not shared
+between cases. Results are printed and written as JSON, and can be compared against a stored baseline:
+
+    uv run python benchmarks/bench_train_bpe.py --output bench.json
+    uv run python benchmarks/bench_train_bpe.py --full --vocab-sizes 1000 5000 --workers 1 4 8
+    uv run python benchmarks/bench_train_bpe.py --save-baseline        # refresh the stored baseline
+
+The exit status is 1 when any case is slower than ``--max-slowdown`` times its baseline. A baseline
+recorded on another machine (Python version, platform or CPU count) is not compared against, and
+cases with more workers than CPUs are left out of a saved baseline.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import pathlib
+import platform
+import random
+import re
+import resource
+import sys
+import tempfile
+
+from cs336_basics.train_bpe import train_bpe
+
+BENCH_DIR = pathlib.Path(__file__).resolve().parent
+FIXTURES_PATH = BENCH_DIR.parent / "tests" / "fixtures"
+BASELINE_PATH = BENCH_DIR / "train_bpe_baseline.json"
+
+SPECIAL_TOKENS = ["<|endoftext|>"]
+SYNTHETIC_UNIT_BYTES = 256 * 1024
+DEFAULT_SCALES = [1, 4, 16]
+FULL_SCALES = [1, 2, 4, 8, 16, 32, 64]
+NOISE_FLOOR_SECONDS = 0.1
+
+
+def make_synthetic_corpus(path: pathlib.Path, scale: int, seed: int = 0):
+    """
+    Write roughly ``scale * SYNTHETIC_UNIT_BYTES`` of TinyStories-like documents to ``path``.
+
+    Words are drawn from the fixture corpora. A fraction of them get a suffix from another word, so the
+    number of distinct pre-tokens keeps growing with corpus size, as it does on real web text.
+    """
+    source = (FIXTURES_PATH / "corpus.en").read_text(encoding="utf-8")
+    source += (FIXTURES_PATH / "tinystories_sample.txt").read_text(encoding="utf-8")
+    words = re.findall(r"\w+|[^\w\s]", source.replace(SPECIAL_TOKENS[0], " "))
+    rng = random.Random(seed)
+    target = scale * SYNTHETIC_UNIT_BYTES
+    written = 0
+    with open(path, "w", encoding="utf-8") as f:
+        while written < target:
+            doc = []
+            for _ in range(rng.randint(50, 400)):
+                word = rng.choice(words)
+                if rng.random() < 0.1:
+                    word += rng.choice(words)[: rng.randint(1, 4)]
+                doc.append(word)
+            text = " ".join(doc) + SPECIAL_TOKENS[0]
+            f.write(text)
+            written += len(text.encode("utf-8"))
+
+
+def _run_case(input_path: str, vocab_size: int, num_workers: int, conn):
+    _, merges, stats = train_bpe(
+        input_path,
+        vocab_size,
+        SPECIAL_TOKENS,
+        num_workers=num_workers,
+        return_stats=True,
+    )
+    rates = [rate for _, rate in stats.merges_per_second()]
+    conn.send(
+        {
+            "seconds": sum(stats.phase_seconds.values()),
+            "phase_seconds": stats.phase_seconds,
+            "num_merges": len(merges),
+            "merges_per_second": len(merges) / stats.phase_seconds["merge"] if stats.phase_seconds["merge"] else None,
+            "min_merges_per_second": min(rates) if rates else None,
+            "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "peak_rss_workers": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+        }
+    )
+    conn.close()
+
+
+def run_case(input_path: pathlib.Path, vocab_size: int, num_workers: int) -> dict:
+    """Train once in a fresh process and return its metrics."""
+    ctx = multiprocessing.get_context("spawn")
+    receiver, sender = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_run_case, args=(str(input_path), vocab_size, num_workers, sender))
+    process.start()
+    sender.close()
+    result = receiver.recv()
+    process.join()
+    return result
+
+
+def case_key(result: dict) -> str:
+    return f"{result['corpus']}|vocab={result['vocab_size']}|workers={result['num_workers']}"
+
+
+def machine_info() -> dict:
+    return {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()}
+
+
+def compare(results: list[dict], baseline: dict, max_slowdown: float, machine: dict) -> list[str]:
+    """
+    Return a description of every case slower than ``max_slowdown`` times its baseline. Timings from
+    another machine say nothing about a regression, so a baseline whose ``machine`` differs is skipped.
+    """
+    if baseline.get("machine") != machine:
+        print(f"WARNING baseline was recorded on {baseline.get('machine')}, not {machine}; skipping comparison")
+        return []
+    reference = {case_key(r): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        base = reference.get(case_key(result))
+        if base is None:
+            continue
+        ratio = result["seconds"] / base["seconds"]
+        result["baseline_ratio"] = ratio
+        # Sub-100ms cases are dominated by noise; only flag them when the absolute gap is real too.
+        if ratio > max_slowdown and result["seconds"] - base["seconds"] > NOISE_FLOOR_SECONDS:
+            regressions.append(f"{case_key(result)}: {result['seconds']:.3f}s vs {base['seconds']:.3f}s ({ratio:.2f}x)")
+    return regressions
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vocab-sizes", type=int, nargs="+", default=[500, 1000])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--scales", type=int, nargs="+", default=None, help="synthetic corpus scales")
+    parser.add_argument("--full", action="store_true", help=f"use scales {FULL_SCALES}")
+    parser.add_argument("--output", type=pathlib.Path, default=None, help="write results as JSON")
+    parser.add_argument("--baseline", type=pathlib.Path, default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="overwrite --baseline with these results")
+    parser.add_argument("--max-slowdown", type=float, default=1.5)
+    args = parser.parse_args(argv)
+
+    scales = args.scales or (FULL_SCALES if args.full else DEFAULT_SCALES)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        corpora = [
+            ("corpus.en", FIXTURES_PATH / "corpus.en"),
+            ("tinystories_sample", FIXTURES_PATH / "tinystories_sample.txt"),
+        ]
+        for scale in scales:
+            path = pathlib.Path(tmp) / f"synthetic_{scale}x.txt"
+            make_synthetic_corpus(path, scale)
+            corpora.append((f"synthetic_{scale}x", path))
+
+        for name, path in corpora:
+            for vocab_size in args.vocab_sizes:
+                for num_workers in args.workers:
+                    result = {
+                        "corpus": name,
+                        "corpus_bytes": os.path.getsize(path),
+                        "vocab_size": vocab_size,
+                        "num_workers": num_workers,
+                        **run_case(path, vocab_size, num_workers),
+                    }
+                    results.append(result)
+                    print(
+                        f"{case_key(result):45s} {result['seconds']:8.3f}s "
+                        f"{result['peak_rss'] / 2**20:8.1f} MiB "
+                        f"{result['merges_per_second'] or 0:10.1f} merges/s",
+                        flush=True,
+                    )
+
+    report = {"machine": machine_info(), "results": results}
+
+    regressions = []
+    if args.save_baseline:
+        # Oversubscribed cases time the scheduler, not the code, so they make a useless reference.
+        cpus = report["machine"]["cpus"] or 1
+        baseline = {**report, "results": [r for r in results if r["num_workers"] <= cpus]}
+        args.baseline.write_text(json.dumps(baseline, indent=2) + "\n")
+    elif args.baseline.exists():
+        regressions = compare(results, json.loads(args.baseline.read_text()), args.max_slowdown, report["machine"])
+        for line in regressions:
+            print(f"REGRESSION {line}")
+
+    if args.output is not None:
+        args.output.write_text(json.dumps(report, indent=2) + "\n")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+"""
+Encode a raw text corpus into a flat token-ID file for the data loader.
+
+    uv run python -m cs336_basics.encode_corpus data/owt_train.txt data/owt_tokenizer.bpetok data/owt_train.bin
+
+The output is a raw ``np.memmap`` (uint16 when every token ID fits, uint32 otherwise) that
+``np.memmap(path, dtype=..., mode="r")`` opens directly, plus ``<output>.doc_offsets.npy``: int64 token
+offsets such that document ``k`` (including its trailing separator token) is ``ids[offsets[k]:offsets[k + 1]]``.
+"""
+
+import argparse
+import mmap
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from cs336_basics.pretokenization_example import find_chunk_boundaries
+from cs336_basics.tokenizer import _call_with_worker_tokenizer, _init_encode_worker, tokenizer
+from cs336_basics.train_bpe import _safe_cut
+
+# Bytes of text per encoding task; bounds the memory each worker and each in-flight result needs.
+ENCODE_SHARD_BYTES = 4 * 1024 * 1024
+# Text handed to ``encode_iterable`` at a time inside a shard.
+ENCODE_PIECE_CHARS = 64 * 1024
+
+
+def token_dtype(tok: tokenizer) -> np.dtype:
+    """Smallest unsigned dtype that holds every token ID of ``tok``."""
+    return np.dtype(np.uint16) if max(tok.vocab) < 2**16 else np.dtype(np.uint32)
+
+
+def _split_range(buf, start: int, end: int, shard_bytes: int, specials: list[bytes]) -> list[tuple[int, int]]:
+    """
+    Cut ``[start, end)`` into pieces of about ``shard_bytes`` at positions where a new pre-token must
+    start and no special token in ``specials`` spans the cut (``train_bpe._safe_cut``). A piece stays
+    longer when no such position exists.
+    """
+    pieces = []
+    while end - start > shard_bytes:
+        cut = _safe_cut(buf, start + shard_bytes, end, specials)
+        if cut >= end:
+            break
+        pieces.append((start, cut))
+        start = cut
+    pieces.append((start, end))
+    return pieces
+
+
+def _encode_range(
+    tok: tokenizer, input_path: str, start: int, end: int, dtype: np.dtype, separator_id: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Encode ``input_path[start:end]``; return the IDs and the positions just after each separator token."""
+    with open(input_path, "rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode("utf-8")
+    pieces = (text[i : i + ENCODE_PIECE_CHARS] for i in range(0, len(text), ENCODE_PIECE_CHARS))
+    ids = tok.encode_iterable_to_array(pieces, dtype=dtype)
+    doc_ends = np.flatnonzero(ids == separator_id) + 1
+    return ids, doc_ends
+
+
+def encode_corpus(
+    input_path: str,
+    tok: tokenizer,
+    output_path: str,
+    num_workers: int = 1,
+    separator: str = "<|endoftext|>",
+    shard_bytes: int = ENCODE_SHARD_BYTES,
+) -> tuple[int, np.ndarray]:
+    """
+    Encode ``input_path`` with ``tok`` straight into a memory-mapped token file at ``output_path``.
+
+    The file is cut at ``separator`` into ``shard_bytes`` shards (``find_chunk_boundaries``); a shard
+    that is still longer, such as one huge document, is cut again at pre-token boundaries
+    (``_split_range``). ``num_workers`` processes read and encode the shards themselves. The tokenizer
+    is sent to each worker once (as just its path when it was loaded with ``tokenizer.from_artifact``).
+    Results are written in order into a memmap preallocated at one token per input byte (no token is
+    shorter than a byte), and the file is truncated to the real length at the end. At most two shards
+    per worker are in flight, so memory stays flat whatever the corpus size, unless a long stretch of
+    text has no ``_safe_cut`` position (an ASCII space between printable characters).
+
+    Returns the number of tokens and the document offsets, which are also saved next to the output.
+    Shards start at a separator or a pre-token boundary, so the IDs equal ``tok.encode`` of the whole
+    file unless a longer special token overlaps the separator at a shard start. ``separator`` must be
+    one of the tokenizer's special tokens.
+    """
+    if separator not in tok.special_ids:
+        raise ValueError(f"Separator {separator!r} is not a special token of the tokenizer")
+    dtype = token_dtype(tok)
+    separator_id = tok.special_ids[separator]
+    specials = [token.encode("utf-8") for token in tok.special_tokens]
+    file_size = os.path.getsize(input_path)
+    ranges = []
+    with open(input_path, "rb") as f:
+        boundaries = find_chunk_boundaries(f, max(file_size // shard_bytes, 1), separator.encode("utf-8"))
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if file_size else memoryview(b"") as buf:
+            for start, end in zip(boundaries[:-1], boundaries[1:]):
+                for piece in _split_range(buf, start, end, shard_bytes, specials):
+                    ranges.append((input_path, *piece, dtype, separator_id))
+
+    with open(output_path, "wb") as f:
+        f.truncate(max(file_size, 1) * dtype.itemsize)
+    out = np.memmap(output_path, dtype=dtype, mode="r+", shape=(max(file_size, 1),))
+    doc_offsets = [np.zeros(1, dtype=np.int64)]
+    num_tokens = 0
+
+    def write(ids: np.ndarray, doc_ends: np.ndarray):
+        nonlocal num_tokens
+        out[num_tokens : num_tokens + len(ids)] = ids
+        doc_offsets.append(doc_ends.astype(np.int64) + num_tokens)
+        num_tokens += len(ids)
+
+    if num_workers <= 1:
+        for args in ranges:
+            write(*_encode_range(tok, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_encode_worker, initargs=(tok,)) as executor:
+            in_flight = deque()
+            for args in ranges:
+                if len(in_flight) >= 2 * num_workers:
+                    write(*in_flight.popleft().result())
+                in_flight.append(executor.submit(_call_with_worker_tokenizer, _encode_range, *args))
+            while in_flight:
+                write(*in_flight.popleft().result())
+
+    out.flush()
+    del out
+    with open(output_path, "r+b") as f:
+        f.truncate(num_tokens * dtype.itemsize)
+
+    doc_offsets = np.concatenate(doc_offsets)
+    if doc_offsets[-1] != num_tokens:
+        doc_offsets = np.append(doc_offsets, num_tokens)
+    np.save(f"{output_path}.doc_offsets.npy", doc_offsets)
+    return num_tokens, doc_offsets
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input_path")
+    parser.add_argument("tokenizer_path", help="artifact written by tokenizer.save")
+    parser.add_argument("output_path")
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--separator", default="<|endoftext|>")
+    args = parser.parse_args()
+
+    tok = tokenizer.from_artifact(args.tokenizer_path)
+    num_tokens, doc_offsets = encode_corpus(
+        args.input_path, tok, args.output_path, num_workers=args.num_workers, separator=args.separator
+    )
+    print(f"Wrote {num_tokens} {token_dtype(tok)} tokens in {len(doc_offsets) - 1} documents to {args.output_path}")
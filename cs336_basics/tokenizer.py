@@ -1,27 +1,110 @@
+import codecs
 import heapq
 import json
+import mmap
+import numpy as np
+import os
+import random
 import regex
+import struct
+import time
 
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from typing import Iterable, Iterator
 
 GPT2_SPLIT_PATTERN = r"'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"
+GPT2_PAT = regex.compile(GPT2_SPLIT_PATTERN)
+
+# Binary tokenizer artifact (see ``tokenizer.save``): header, then uint32 sections
+#   vocab ids[V] (ascending), vocab offsets[V + 1], merges[M, 3] as (left id, right id, merged id),
+#   byte ids[256], special offsets[S + 1], special ids[S]
+# then, 8-byte aligned, the packed ``merge_ids`` table as uint64 keys[K] and values[K], followed by the
+# vocab bytes blob and the UTF-8 special-token blob.
+ARTIFACT_MAGIC = b"BPETOK\x00\x00"
+ARTIFACT_VERSION = 2
+_ARTIFACT_HEADER = struct.Struct("<8sIIIIIII")
+# Token-ID pairs pack into one int: ``left << PAIR_SHIFT | right`` (as in ``train_bpe``).
+PAIR_SHIFT = 32
+PAIR_MASK = (1 << PAIR_SHIFT) - 1
+RANK_MASK = ~PAIR_MASK
+# Larger than any packed (rank, merged id) entry: "no merge for this pair".
+NO_MERGE = 1 << 63
+
+# Placeholder in the lookup tables for bytes that have no vocab entry.
+NO_TOKEN = 0xFFFFFFFF
+
+# Batches per worker in ``encode_batch_array``: enough to balance uneven documents, few enough to
+# keep the per-batch IPC small.
+ENCODE_BATCHES_PER_WORKER = 4
+
+# Byte length from which the heap merge beats the scan merge; measured with the GPT-2 vocab.
+DEFAULT_MERGE_CUTOFF = 48
+
+# IDs gathered per slice by ``decode_array``/``decode_to_file``.
+DECODE_SLICE_TOKENS = 1 << 16
+
+# Distinct pre-tokens kept by the encode cache; natural text mostly repeats a few thousand words.
+DEFAULT_CACHE_SIZE = 1 << 16
+
+# IDs collected in a list before ``encode_to_array`` moves them into its typed array.
+ARRAY_BLOCK_TOKENS = 1 << 16
+
 
 class tokenizer:
-    def __init__(self, vocab, merges, special_tokens=None):
+    def __init__(self, vocab, merges, special_tokens=None, cache_size: int = DEFAULT_CACHE_SIZE):
+        """
+        ``cache_size`` bounds the LRU cache from pre-token to token IDs that ``encode`` (and everything
+        built on it) consults first; 0 disables it. ``cache_hits``/``cache_misses`` count lookups.
+        """
         self.vocab = vocab
         self.merges = merges
-        self.special_tokens = special_tokens if special_tokens is not None else []
         self.byte2id = {v : k for k, v in vocab.items()}
         self.merge_rank = {pair : i for i, pair in enumerate(merges)}
+        # The merges on token IDs: packed (left id, right id) -> packed (rank, merged id). A merge whose
+        # bytes are not all in the vocab can never apply to IDs and is left out.
+        self.byte_ids = [self.byte2id.get(bytes([b])) for b in range(256)]
+        self.merge_ids: dict[int, int] = {}
+        for rank, (first, second) in enumerate(merges):
+            left, right, merged = self.byte2id.get(first), self.byte2id.get(second), self.byte2id.get(first + second)
+            if left is not None and right is not None and merged is not None:
+                self.merge_ids[(left << PAIR_SHIFT) | right] = (rank << PAIR_SHIFT) | merged
+        self.artifact: _Artifact | None = None
+        special_tokens = special_tokens if special_tokens is not None else []
+        special_ids = {tok: self.byte2id.get(tok.encode("utf-8")) for tok in special_tokens}
+        special_ids = {tok: tok_id for tok, tok_id in special_ids.items() if tok_id is not None}
+        self._init_state(special_tokens, special_ids, cache_size)
+
+    def _init_state(self, special_tokens: list[str], special_ids: dict[str, int], cache_size: int):
+        """Set up what does not depend on how the vocab and merges are stored."""
+        self.special_tokens = special_tokens
+        self.special_ids = special_ids
         self.special_tokens_sorted = sorted(self.special_tokens, key=len, reverse=True)
+        # Alternatives are tried in order at each position, so longest-first gives longest match.
+        self.special_pat = (
+            regex.compile("(" + "|".join(regex.escape(tok) for tok in self.special_tokens_sorted if tok) + ")")
+            if any(self.special_tokens)
+            else None
+        )
+        # Proper prefixes of special tokens, for holding back text in ``encode_iterable``.
+        self.special_prefixes = {tok[:k] for tok in self.special_tokens for k in range(1, len(tok))}
+        self.max_special_len = max(map(len, self.special_tokens), default=0)
+        # Pre-tokens shorter than this many bytes use ``_bpe_merge_scan``; see ``calibrate_merge_cutoff``.
+        self.merge_cutoff = DEFAULT_MERGE_CUTOFF
+        self.cache_size = cache_size
+        self._vocab_arrays = None
+        self.cache: OrderedDict[str, list[int]] = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
 
     @classmethod
-    def from_file(cls, vocab_filepath, merges_filepath, special_tokens=None):
+    def from_file(cls, vocab_filepath, merges_filepath, special_tokens=None, cache_size: int = DEFAULT_CACHE_SIZE):
         vocab = cls._load_vocab(vocab_filepath)
 
         merges = cls._load_merges(merges_filepath)
 
-        return cls(vocab, merges, special_tokens)
+        return cls(vocab, merges, special_tokens, cache_size)
     
     @staticmethod
     def _load_vocab(filepath):
@@ -52,121 +135,676 @@ class tokenizer:
 
         return merges
 
-    def encode(self, text: str) -> list[int]:
+    def save(self, filepath):
+        """
+        Write the vocab, merges and special tokens as one versioned binary artifact. Unlike the JSON
+        vocab and text merges it keeps merges whose bytes are not valid UTF-8. Written atomically.
+        """
+        ids = sorted(self.vocab)
+        first_id: dict[bytes, int] = {}
+        for i in ids:
+            first_id.setdefault(self.vocab[i], i)
 
-        if not text:
-            return []
-        
-        def split_specials(s : str):
-            specials = self.special_tokens_sorted
-            normal = []
-            i = 0
-            while i < len(s):
-                for tok in specials:
-                    if s.startswith(tok, i):
-                        if normal:
-                            yield False, "".join(normal)
-                            normal = []
-                        yield True, tok
-                        i += len(tok)
-                        break
-                else:
-                    normal.append(s[i])
-                    i += 1
-            if normal:
-                yield False, "".join(normal)
-        
-        def bpe_merge(chunk: bytes) -> list[bytes]:
+        vocab_offsets = array("I", [0])
+        for i in ids:
+            vocab_offsets.append(vocab_offsets[-1] + len(self.vocab[i]))
+        merge_table = array("I")
+        for first, second in self.merges:
+            if first not in first_id or second not in first_id:
+                raise ValueError(f"Merge {(first, second)!r} uses bytes that are not in the vocab")
+            merge_table.extend((first_id[first], first_id[second], first_id.get(first + second, NO_TOKEN)))
+        byte_ids = array("I", (NO_TOKEN if i is None else i for i in self.byte_ids))
+        specials = [tok.encode("utf-8") for tok in self.special_tokens]
+        special_offsets = array("I", [0])
+        for tok in specials:
+            special_offsets.append(special_offsets[-1] + len(tok))
+        special_ids = array("I", (self.special_ids.get(tok, NO_TOKEN) for tok in self.special_tokens))
+        merge_keys = array("Q", self.merge_ids.keys())
+        merge_values = array("Q", self.merge_ids.values())
 
-            if not chunk:
-                return []
-            
-            tokens = [bytes([blist]) for blist in chunk]
-            n = len(tokens)
-            prev = [i - 1 for i in range(n)]
-            nxt = [i + 1 for i in range(n)]
-            nxt[-1] = -1
-            alive = [True] * n
-
-            heap: list[tuple[int, int]] = []
-            for i in range(n - 1):
-                pair = (tokens[i], tokens[i + 1])
-                rank = self.merge_rank.get(pair)
-                if rank is not None:
-                    heapq.heappush(heap, (rank, i))
-
-            while heap:
-                rank, i = heapq.heappop(heap)
-                # 判断pair是否失效
-                if not alive[i]:
-                    continue
-                j = nxt[i]
-                if j == -1 or not alive[j]:
-                    continue
-                
-                # 确认这一对组合当前的rank仍然和堆顶的rank匹配(懒惰删除过期项)
-                pair = (tokens[i], tokens[j])
-                current_rank = self.merge_rank.get(pair)
-                if current_rank != rank:
-                    continue
+        vocab_blob = b"".join(self.vocab[i] for i in ids)
+        special_blob = b"".join(specials)
+        header = _ARTIFACT_HEADER.pack(
+            ARTIFACT_MAGIC,
+            ARTIFACT_VERSION,
+            len(ids),
+            len(self.merges),
+            len(specials),
+            len(merge_keys),
+            len(vocab_blob),
+            len(special_blob),
+        )
+        tmp_path = f"{filepath}.tmp{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            for section in (array("I", ids), vocab_offsets, merge_table, byte_ids, special_offsets, special_ids):
+                section.tofile(f)
+            f.write(bytes(-f.tell() % 8))
+            merge_keys.tofile(f)
+            merge_values.tofile(f)
+            f.write(vocab_blob)
+            f.write(special_blob)
+        os.replace(tmp_path, filepath)
+
+    @classmethod
+    def from_artifact(cls, filepath, cache_size: int = DEFAULT_CACHE_SIZE):
+        """
+        Load a tokenizer written by ``save``. The file is memory-mapped and read in place, so every process
+        that loads the same artifact shares its pages, and loading takes constant time: the dicts
+        ``merge_ids`` (on the first encode), ``vocab``, ``byte2id``, ``merges`` and ``merge_rank`` are
+        only built in a process that uses them. Pickling the result sends just the path.
+        """
+        tok = cls.__new__(cls)
+        tok._attach(_Artifact(filepath), cache_size)
+        return tok
+
+    def _attach(self, artifact: "_Artifact", cache_size: int):
+        self.artifact = artifact
+        self.byte_ids = [None if i == NO_TOKEN else i for i in artifact.byte_ids.tolist()]
+        special_tokens = artifact.special_tokens()
+        special_ids = dict(zip(special_tokens, artifact.special_ids.tolist()))
+        special_ids = {tok: tok_id for tok, tok_id in special_ids.items() if tok_id != NO_TOKEN}
+        self._init_state(special_tokens, special_ids, cache_size)
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not set: the tables an artifact-backed tokenizer builds lazily.
+        artifact = self.__dict__.get("artifact")
+        if artifact is None or name not in ("vocab", "byte2id", "merges", "merge_rank", "merge_ids"):
+            raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+        if name == "vocab":
+            value = artifact.vocab()
+        elif name == "byte2id":
+            value = {v : k for k, v in self.vocab.items()}
+        elif name == "merges":
+            triples = iter(artifact.merge_table.tolist())
+            value = [(self.vocab[left], self.vocab[right]) for left, right, _ in zip(triples, triples, triples)]
+        elif name == "merge_rank":
+            value = {pair : i for i, pair in enumerate(self.merges)}
+        else:
+            value = dict(zip(artifact.merge_keys.tolist(), artifact.merge_values.tolist()))
+        setattr(self, name, value)
+        return value
+
+    def __getstate__(self):
+        if self.artifact is None:
+            return self.__dict__
+        return {
+            "artifact_handle": self.artifact.handle(),
+            "cache_size": self.cache_size,
+            "merge_cutoff": self.merge_cutoff,
+        }
+
+    def __setstate__(self, state):
+        if "artifact_handle" not in state:
+            self.__dict__.update(state)
+            return
+        self._attach(_Artifact(*state["artifact_handle"]), state["cache_size"])
+        self.merge_cutoff = state["merge_cutoff"]
+
+    def calibrate_merge_cutoff(self, lengths: Iterable[int] = (8, 16, 24, 32, 48, 64, 96, 128, 192, 256),
+                               samples: int = 20, seed: int = 0) -> int:
+        """
+        Time both merge strategies on pre-tokens of each length and set ``merge_cutoff`` to the shortest
+        length from which the heap is faster at every tested length. The pre-tokens are runs of random
+        vocab entries, so they merge the way real text does. Returns the new cutoff.
+        """
+        rng = random.Random(seed)
+        tokens = [tok for tok in self.vocab.values() if tok.decode("utf-8", errors="ignore").encode("utf-8") == tok]
+        lengths = sorted(lengths)
+        heap_wins = []
+        for length in lengths:
+            batch = []
+            for _ in range(samples):
+                data = b""
+                while len(data) < length:
+                    data += rng.choice(tokens)
+                batch.append([self.byte_ids[b] for b in data[:length]])
+            if None in batch[0]:
+                raise ValueError("calibrate_merge_cutoff needs every byte in the vocab")
+            timings = []
+            for merge in (self._bpe_merge_scan, self._bpe_merge):
+                best = float("inf")
+                for _ in range(3):
+                    start = time.perf_counter()
+                    for ids in batch:
+                        merge(list(ids))
+                    best = min(best, time.perf_counter() - start)
+                timings.append(best)
+            heap_wins.append(timings[1] < timings[0])
+        cutoff = lengths[-1] + 1
+        for length, wins in zip(reversed(lengths), reversed(heap_wins)):
+            if not wins:
+                break
+            cutoff = length
+        self.merge_cutoff = cutoff
+        return cutoff
 
-                tokens[i] = tokens[i] + tokens[j]
-                alive[j] = False
-
-                # 维护链表
-                nj = nxt[j]
-                nxt[i] = nj
-                if nj != -1:
-                    prev[nj] = i
-                
-                # 左邻对入堆
-                li = prev[i]
-                if li != -1 and alive [li]:
-                    pair_left = (tokens[li], tokens[i])
-                    r_left = self.merge_rank.get((tokens[li], tokens[i]))
-                    if r_left is not None:
-                        heapq.heappush(heap, (r_left, li))
-
-                # 右邻对入堆
-                if nj != -1 and alive[nj]:
-                    pair_right = (tokens[i], tokens[nj])
-                    r_right = self.merge_rank.get((tokens[i], tokens[nj]))
-                    if r_right is not None:
-                        heapq.heappush(heap, (r_right, i))
-
-            res = []
-            idx = 0
-            while idx != -1 and idx < n:
-                if alive[idx]:
-                    res.append(tokens[idx])
-                idx = nxt[idx]
-
-            return res 
+    def _bpe_merge_scan(self, ids: list[int]) -> list[int]:
+        """
+        Same result as ``_bpe_merge`` by repeatedly scanning for the lowest-rank pair. Quadratic, but
+        ``min``/``list.index`` run in C, so it beats the heap on short pre-tokens.
+        """
+        merge_ids = self.merge_ids
+        # Entries are packed (rank, merged id), so the smallest is the lowest rank and ``index`` finds
+        # its leftmost occurrence, the same tie-break as the heap.
+        entries = [merge_ids.get((left << PAIR_SHIFT) | right, NO_MERGE) for left, right in zip(ids, ids[1:])]
+        while entries:
+            best = min(entries)
+            if best == NO_MERGE:
+                break
+            i = entries.index(best)
+            ids[i] = best & PAIR_MASK
+            del ids[i + 1]
+            del entries[i]
+            if i < len(entries):
+                entries[i] = merge_ids.get((ids[i] << PAIR_SHIFT) | ids[i + 1], NO_MERGE)
+            if i:
+                entries[i - 1] = merge_ids.get((ids[i - 1] << PAIR_SHIFT) | ids[i], NO_MERGE)
+        return ids
+
+    def _bpe_merge(self, ids: list[int]) -> list[int]:
+        """
+        Apply the merges to a pre-token's token IDs, lowest rank first, entirely on ints. Heap entries
+        are ``rank << PAIR_SHIFT | position`` so they compare as plain ints.
+        """
+        n = len(ids)
+        if n < 2:
+            return ids
+        merge_ids = self.merge_ids
+        prev = list(range(-1, n - 1))
+        nxt = list(range(1, n + 1))
+        nxt[-1] = -1
+
+        heap: list[int] = []
+        for i in range(n - 1):
+            entry = merge_ids.get((ids[i] << PAIR_SHIFT) | ids[i + 1])
+            if entry is not None:
+                heap.append((entry & RANK_MASK) | i)
+        heapq.heapify(heap)
+
+        while heap:
+            item = heapq.heappop(heap)
+            i = item & PAIR_MASK
+            # 判断pair是否失效 (merged-away positions hold -1)
+            if ids[i] < 0:
+                continue
+            j = nxt[i]
+            if j == -1:
+                continue
+
+            # 确认这一对组合当前的rank仍然和堆顶的rank匹配(懒惰删除过期项)
+            entry = merge_ids.get((ids[i] << PAIR_SHIFT) | ids[j])
+            if entry is None or entry & RANK_MASK != item & RANK_MASK:
+                continue
+
+            ids[i] = entry & PAIR_MASK
+            ids[j] = -1
+
+            # 维护链表
+            nj = nxt[j]
+            nxt[i] = nj
+            if nj != -1:
+                prev[nj] = i
+
+            # 左邻对入堆
+            li = prev[i]
+            if li != -1:
+                entry = merge_ids.get((ids[li] << PAIR_SHIFT) | ids[i])
+                if entry is not None:
+                    heapq.heappush(heap, (entry & RANK_MASK) | li)
+
+            # 右邻对入堆
+            if nj != -1:
+                entry = merge_ids.get((ids[i] << PAIR_SHIFT) | ids[nj])
+                if entry is not None:
+                    heapq.heappush(heap, (entry & RANK_MASK) | i)
+
+        return [tok_id for tok_id in ids if tok_id >= 0]
+
+    def _encode_pretoken(self, pretoken: str) -> list[int]:
+        """Token IDs of one pre-token, served from the LRU cache when possible."""
+        cache = self.cache
+        ids = cache.get(pretoken)
+        if ids is not None:
+            cache.move_to_end(pretoken)
+            self.cache_hits += 1
+            return ids
+        self.cache_misses += 1
+        byte_ids = self.byte_ids
+        ids = [byte_ids[b] for b in pretoken.encode("utf-8")]
+        if None in ids:
+            raise KeyError(f"Token bytes {bytes([pretoken.encode('utf-8')[ids.index(None)]])} not in vocab")
+        ids = self._bpe_merge_scan(ids) if len(ids) < self.merge_cutoff else self._bpe_merge(ids)
+        if self.cache_size > 0:
+            cache[pretoken] = ids
+            if len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        return ids
+
+    def _special_id(self, token: str) -> int:
+        tok_id = self.special_ids.get(token)
+        if tok_id is None:
+            raise KeyError(f"Special token {token!r} not in vocab")
+        return tok_id
+
+    def _split_specials(self, text: str) -> Iterator[tuple[bool, str]]:
+        """Yield ``(is_special, segment)`` in order; at each position the longest special token wins."""
+        if self.special_pat is None:
+            yield False, text
+            return
+        for k, segment in enumerate(self.special_pat.split(text)):
+            if k % 2:
+                yield True, segment
+            elif segment:
+                yield False, segment
+
+    def _iter_token_ids(self, text: str) -> Iterator[list[int]]:
+        """
+        Lazily yield the IDs of ``text`` one pre-token or special token at a time, without slicing or
+        splitting the whole text up front.
+        """
+        start = 0
+        specials = self.special_pat.finditer(text) if self.special_pat is not None else ()
+        for m in specials:
+            for sub in GPT2_PAT.finditer(text, start, m.start()):
+                yield self._encode_pretoken(sub.group())
+            yield [self._special_id(m.group())]
+            start = m.end()
+        for sub in GPT2_PAT.finditer(text, start):
+            yield self._encode_pretoken(sub.group())
+
+    def count_tokens(self, text: str) -> int:
+        """``len(self.encode(text))`` in memory independent of the text length: no ID or pre-token list."""
+        return sum(map(len, self._iter_token_ids(text)))
+
+    def encode(self, text: str, max_tokens: int | None = None) -> list[int]:
+        """
+        Encode ``text``. With ``max_tokens`` the result is ``encode(text)[:max_tokens]``, but splitting and
+        merging stop as soon as that many IDs exist.
+        """
+        if not text:
+            return []
 
         token_ids : list[int] = []
-        for is_special, segment in split_specials(text):
+        if max_tokens is not None:
+            if max_tokens <= 0:
+                return token_ids
+            for ids in self._iter_token_ids(text):
+                token_ids.extend(ids)
+                if len(token_ids) >= max_tokens:
+                    del token_ids[max_tokens:]
+                    break
+            return token_ids
+
+        for is_special, segment in self._split_specials(text):
             if is_special:
-                seg_bytes = segment.encode("utf-8")
-                tok_id = self.byte2id.get(seg_bytes)
-                if tok_id is None:
-                    raise KeyError(f"Special token {segment!r} not in vocab")
-                token_ids.append(tok_id)
+                token_ids.append(self._special_id(segment))
             else:
-                for sub_text in regex.findall(GPT2_SPLIT_PATTERN, segment):
-                    for tok in bpe_merge(sub_text.encode("utf-8")):
-                        tok_id = self.byte2id.get(tok)
-                        if tok_id is None:
-                            raise KeyError(f"Token bytes {tok} not in vocab")
-                        token_ids.append(tok_id)
+                for sub_text in GPT2_PAT.findall(segment):
+                    token_ids.extend(self._encode_pretoken(sub_text))
 
         return token_ids
 
     def encode_iterable(self, iterable: Iterable[str]) -> Iterator[int]:
+        """
+        Lazily yield the IDs of ``encode("".join(iterable))``. Between chunks only the trailing text whose
+        encoding may still change (an incomplete pre-token or special-token prefix) is kept, so memory
+        is bounded by the longest pre-token rather than by the chunk size.
+        """
+        for ids in self._iter_stable_chunks(iterable):
+            yield from ids
+
+    def _iter_stable_chunks(self, iterable: Iterable[str]) -> Iterator[list[int]]:
+        """The IDs of ``encode("".join(iterable))`` as one list per input chunk (see ``encode_iterable``)."""
+        pending = ""
         for chunk in iterable:
-            for tok_id in self.encode(chunk):
-                yield tok_id
+            if not chunk:
+                continue
+            pending += chunk
+            ids, consumed = self._encode_stable_prefix(pending)
+            yield ids
+            pending = pending[consumed:]
+        yield self.encode(pending)
+
+    def _encode_stable_prefix(self, text: str) -> tuple[list[int], int]:
+        """
+        Encode the longest prefix of ``text`` whose IDs cannot change whatever text follows; return the IDs
+        and the prefix length. The prefix ends at a special token or a pre-token boundary.
+        """
+        # Positions from which the rest of ``text`` could still grow into a (longer) special token.
+        open_specials = [
+            i
+            for i in range(max(len(text) - self.max_special_len + 1, 0), len(text))
+            if text[i:] in self.special_prefixes
+        ]
+
+        def first_open_special(pos: int) -> int:
+            return next((i for i in open_specials if i >= pos), len(text))
+
+        token_ids: list[int] = []
+        start = 0
+        if self.special_pat is not None:
+            for m in self.special_pat.finditer(text):
+                # A match is final unless a special token could still start at or before it.
+                if first_open_special(start) <= m.start():
+                    break
+                for sub_text in GPT2_PAT.findall(text[start : m.start()]):
+                    token_ids.extend(self._encode_pretoken(sub_text))
+                token_ids.append(self._special_id(m.group()))
+                start = m.end()
+        end = first_open_special(start)
+
+        # The segment after the last special may continue. The split pattern looks at most one character
+        # past a match, so a match is final once at least two characters of the segment follow it.
+        segment = text[start:end]
+        stable = start
+        for m in GPT2_PAT.finditer(segment):
+            if m.end() > len(segment) - 2:
+                break
+            token_ids.extend(self._encode_pretoken(m.group()))
+            stable = start + m.end()
+        return token_ids, stable
 
+    def encode_to_array(self, text: str, dtype=np.uint16) -> np.ndarray:
+        """
+        ``np.array(self.encode(text), dtype=dtype)`` without the list of the whole text: IDs are moved into
+        a growable ``dtype`` array every ``ARRAY_BLOCK_TOKENS``. Raises ``ValueError`` if an ID of ``text``
+        does not fit ``dtype``.
+        """
+        buffer = _IdBuffer(dtype)
+        block: list[int] = []
+        encode_pretoken = self._encode_pretoken
+
+        def encode_range(start: int, end: int):
+            nonlocal block
+            if end - start <= ARRAY_BLOCK_TOKENS:
+                for sub_text in GPT2_PAT.findall(text, start, end):
+                    block += encode_pretoken(sub_text)
+            else:
+                # The ``findall`` list of a long document takes far more memory than its IDs; match lazily.
+                for sub in GPT2_PAT.finditer(text, start, end):
+                    block += encode_pretoken(sub.group())
+                    if len(block) >= ARRAY_BLOCK_TOKENS:
+                        buffer.extend(block)
+                        block = []
+            if len(block) >= ARRAY_BLOCK_TOKENS:
+                buffer.extend(block)
+                block = []
+
+        start = 0
+        specials = self.special_pat.finditer(text) if self.special_pat is not None else ()
+        for m in specials:
+            encode_range(start, m.start())
+            block.append(self._special_id(m.group()))
+            start = m.end()
+        encode_range(start, len(text))
+        buffer.extend(block)
+        return buffer.finish()
+
+    def encode_iterable_to_array(self, iterable: Iterable[str], dtype=np.uint16) -> np.ndarray:
+        """``encode_to_array("".join(iterable), dtype)``, reading the text chunk by chunk as ``encode_iterable``."""
+        buffer = _IdBuffer(dtype)
+        for ids in self._iter_stable_chunks(iterable):
+            buffer.extend(ids)
+        return buffer.finish()
+
+    def encode_batch(self, texts: Iterable[str], num_workers: int = 1) -> list[list[int]]:
+        """``[self.encode(text) for text in texts]``, over ``num_workers`` processes (see ``encode_batch_array``)."""
+        ids, offsets = self.encode_batch_array(texts, num_workers)
+        ids, offsets = ids.tolist(), offsets.tolist()
+        return [ids[a:b] for a, b in zip(offsets, offsets[1:])]
+
+    def encode_batch_array(self, texts: Iterable[str], num_workers: int = 1) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Encode many documents into one flat int32 array of token IDs plus int64 offsets: document ``k`` is
+        ``ids[offsets[k]:offsets[k + 1]]``. With ``num_workers > 1`` documents are encoded in batches by
+        a process pool that receives this tokenizer once, at start-up (only the path of a tokenizer
+        loaded with ``from_artifact``); order is preserved. Each worker keeps its own pre-token cache.
+        """
+        texts = list(texts)
+        if num_workers <= 1 or len(texts) <= 1:
+            parts = [self._encode_flat(texts)]
+        else:
+            batch_size = -(-len(texts) // (num_workers * ENCODE_BATCHES_PER_WORKER))
+            batches = [texts[i : i + batch_size] for i in range(0, len(texts), batch_size)]
+            with ProcessPoolExecutor(
+                max_workers=num_workers, initializer=_init_encode_worker, initargs=(self,)
+            ) as executor:
+                parts = list(executor.map(_encode_batch_worker, batches))
+        offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        np.cumsum(np.concatenate([lengths for _, lengths in parts]), out=offsets[1:])
+        return np.concatenate([ids for ids, _ in parts]), offsets
+
+    def _encode_flat(self, texts: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        ids = array("i")
+        lengths = np.empty(len(texts), dtype=np.int64)
+        for k, text in enumerate(texts):
+            encoded = self.encode(text)
+            ids.extend(encoded)
+            lengths[k] = len(encoded)
+        return np.frombuffer(ids, dtype=np.int32), lengths
 
     def decode(self, ids: list[int]) -> str:
+        if self.artifact is not None:
+            # Gathered from the mapped vocab blob, so decode-only processes never build the vocab dict.
+            return self.decode_array(np.asarray(ids, dtype=np.intp))
         byte_seq = b"".join(self.vocab[i] for i in ids)
         return byte_seq.decode("utf-8", errors="replace")
+
+    def decode_array(self, ids: np.ndarray, slice_tokens: int = DECODE_SLICE_TOKENS) -> str:
+        """``decode`` for a NumPy array or memmap of IDs, gathered in vectorized slices (see ``decode_to_file``)."""
+        data = b"".join(self._gather_bytes(ids[k : k + slice_tokens]) for k in range(0, len(ids), slice_tokens))
+        return data.decode("utf-8", errors="replace")
+
+    def decode_to_file(self, ids: np.ndarray, filepath, slice_tokens: int = DECODE_SLICE_TOKENS) -> int:
+        """
+        Write the bytes of ``ids`` (a NumPy array or memmap) to ``filepath`` ``slice_tokens`` IDs at a time,
+        so memory stays at one slice however long ``ids`` is. Returns the number of bytes written.
+        """
+        written = 0
+        with open(filepath, "wb") as f:
+            for k in range(0, len(ids), slice_tokens):
+                data = self._gather_bytes(ids[k : k + slice_tokens])
+                f.write(data)
+                written += len(data)
+        return written
+
+    def _vocab_table(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """The vocab as one uint8 blob plus offsets and lengths indexed by token ID (built on first use)."""
+        if self._vocab_arrays is None and self.artifact is not None:
+            # Artifact vocab IDs are sorted and its blob is in ID order: only the index arrays are built.
+            ids = self.artifact.ids.astype(np.intp)
+            size = int(ids[-1]) + 1 if len(ids) else 0
+            lengths = np.full(size, -1, dtype=np.int32)
+            offsets = np.zeros(size, dtype=np.int32)
+            lengths[ids] = np.diff(self.artifact.vocab_offsets)
+            offsets[ids] = self.artifact.vocab_offsets[:-1]
+            self._vocab_arrays = self.artifact.vocab_blob, offsets, lengths
+        if self._vocab_arrays is None:
+            size = max(self.vocab, default=-1) + 1
+            lengths = np.full(size, -1, dtype=np.int32)
+            offsets = np.zeros(size, dtype=np.int32)
+            ids = sorted(self.vocab)
+            lengths[ids] = [len(self.vocab[i]) for i in ids]
+            offsets[ids] = np.cumsum(lengths[ids]) - lengths[ids]
+            blob = np.frombuffer(b"".join(self.vocab[i] for i in ids), dtype=np.uint8)
+            self._vocab_arrays = blob, offsets, lengths
+        return self._vocab_arrays
+
+    def _gather_bytes(self, ids: np.ndarray) -> bytes:
+        blob, offsets, lengths = self._vocab_table()
+        ids = np.asarray(ids, dtype=np.intp)
+        if len(ids) and (ids.min() < 0 or ids.max() >= len(lengths) or (lengths[ids] < 0).any()):
+            bad = ids[(ids < 0) | (ids >= len(lengths))]
+            raise KeyError(int(bad[0]) if len(bad) else int(ids[lengths[ids] < 0][0]))
+        token_lengths = lengths[ids]
+        nonempty = token_lengths > 0
+        token_lengths, starts = token_lengths[nonempty], offsets[ids[nonempty]]
+        if not len(starts):
+            return b""
+        # Blob positions step by one inside a token and jump at each token's first byte, so they are
+        # the cumulative sum of ones with the jumps written at the token boundaries.
+        steps = np.ones(token_lengths.sum(), dtype=np.int32)
+        steps[0] = starts[0]
+        steps[np.cumsum(token_lengths[:-1])] = starts[1:] - (starts[:-1] + token_lengths[:-1] - 1)
+        return blob[np.cumsum(steps, out=steps)].tobytes()
+
+    def decode_stream(self) -> "StreamDecoder":
+        """A stateful decoder that turns IDs into text one at a time (see ``StreamDecoder``)."""
+        if self.artifact is not None:
+            return StreamDecoder(_VocabView(*self._vocab_table()))
+        return StreamDecoder(self.vocab)
+
+    def decode_iterable(self, ids: Iterable[int]) -> Iterator[str]:
+        """Lazily yield the text of ``ids`` as it completes; the pieces join to ``decode(list(ids))``."""
+        stream = self.decode_stream()
+        for tok_id in ids:
+            text = stream.push(tok_id)
+            if text:
+                yield text
+        text = stream.flush()
+        if text:
+            yield text
+
+
+class _Artifact:
+    """
+    A tokenizer artifact (see ``tokenizer.save``) mapped read-only into memory, with NumPy views of its
+    sections. ``identity`` (from ``handle``) makes opening fail if the file was replaced since.
+    """
+
+    def __init__(self, filepath, identity: tuple[int, ...] | None = None):
+        self.path = os.path.abspath(filepath)
+        with open(self.path, "rb") as f:
+            self.identity = _file_identity(os.fstat(f.fileno()))
+            if identity is not None and tuple(identity) != self.identity:
+                raise ValueError(f"{self.path} has changed since the tokenizer was loaded from it")
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mm = self.mm
+        if len(mm) < _ARTIFACT_HEADER.size:
+            raise ValueError(f"{filepath} is not a tokenizer artifact")
+        magic, version, num_vocab, num_merges, num_specials, num_merge_ids, vocab_len, special_len = (
+            _ARTIFACT_HEADER.unpack_from(mm, 0)
+        )
+        if magic != ARTIFACT_MAGIC:
+            raise ValueError(f"{filepath} is not a tokenizer artifact")
+        if version != ARTIFACT_VERSION:
+            raise ValueError(f"{filepath} has artifact version {version}, expected {ARTIFACT_VERSION}")
+        sizes = (num_vocab, num_vocab + 1, 3 * num_merges, 256, num_specials + 1, num_specials)
+        merge_ids_pos = _ARTIFACT_HEADER.size + 4 * sum(sizes)
+        merge_ids_pos += -merge_ids_pos % 8
+        vocab_pos = merge_ids_pos + 16 * num_merge_ids
+        if len(mm) != vocab_pos + vocab_len + special_len:
+            raise ValueError(f"{filepath} is truncated or corrupt")
+
+        pos = _ARTIFACT_HEADER.size
+        sections = []
+        for size in sizes:
+            sections.append(np.frombuffer(mm, dtype="<u4", count=size, offset=pos))
+            pos += 4 * size
+        self.ids, self.vocab_offsets, self.merge_table, self.byte_ids, self.special_offsets, self.special_ids = sections
+        merge_ids = np.frombuffer(mm, dtype="<u8", count=2 * num_merge_ids, offset=merge_ids_pos)
+        self.merge_keys, self.merge_values = merge_ids[:num_merge_ids], merge_ids[num_merge_ids:]
+        self.vocab_blob = np.frombuffer(mm, dtype=np.uint8, count=vocab_len, offset=vocab_pos)
+        self.special_blob = mm[vocab_pos + vocab_len : vocab_pos + vocab_len + special_len]
+
+    def handle(self) -> tuple[str, tuple[int, ...]]:
+        """What a process needs to open this artifact again: its path and file identity."""
+        return self.path, self.identity
+
+    def special_tokens(self) -> list[str]:
+        offsets = self.special_offsets.tolist()
+        return [self.special_blob[a:b].decode("utf-8") for a, b in zip(offsets, offsets[1:])]
+
+    def vocab(self) -> dict[int, bytes]:
+        blob = self.vocab_blob.tobytes()
+        offsets = self.vocab_offsets.tolist()
+        return dict(zip(self.ids.tolist(), [blob[a:b] for a, b in zip(offsets, offsets[1:])]))
+
+
+def _file_identity(st: os.stat_result) -> tuple[int, ...]:
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class _IdBuffer:
+    """A growable integer array that doubles its capacity and is trimmed in place when finished."""
+
+    def __init__(self, dtype):
+        self.dtype = np.dtype(dtype)
+        if self.dtype.kind not in "iu":
+            raise ValueError(f"Token IDs need an integer dtype, got {self.dtype}")
+        self.data = np.empty(ARRAY_BLOCK_TOKENS, dtype=self.dtype)
+        self.size = 0
+
+    def extend(self, ids: list[int]):
+        end = self.size + len(ids)
+        if end > len(self.data):
+            self.data.resize(max(2 * len(self.data), end), refcheck=False)
+        try:
+            self.data[self.size : end] = ids
+        except OverflowError:
+            info = np.iinfo(self.dtype)
+            bad = next(i for i in ids if not info.min <= i <= info.max)
+            raise ValueError(f"Token ID {bad} does not fit {self.dtype}") from None
+        self.size = end
+
+    def finish(self) -> np.ndarray:
+        self.data.resize(self.size, refcheck=False)
+        return self.data
+
+
+class _VocabView:
+    """Read-only ``id -> bytes`` lookup over ``tokenizer._vocab_table``, sharing an artifact's mapped blob."""
+
+    __slots__ = ("blob", "offsets", "lengths")
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray, lengths: np.ndarray):
+        self.blob, self.offsets, self.lengths = blob, offsets, lengths
+
+    def __getitem__(self, token_id: int) -> bytes:
+        length = int(self.lengths[token_id]) if 0 <= token_id < len(self.lengths) else -1
+        if length < 0:
+            raise KeyError(token_id)
+        offset = int(self.offsets[token_id])
+        return self.blob[offset : offset + length].tobytes()
+
+
+class StreamDecoder:
+    """
+    Incremental ``tokenizer.decode`` for token-by-token generation. ``push`` returns the text completed by
+    one more token; a multi-byte UTF-8 character split across tokens is held back (at most 3 bytes)
+    until its last byte arrives instead of decoding to replacement characters. ``flush`` ends the
+    stream and returns whatever is left, with ``errors="replace"`` like ``decode``.
+    """
+
+    __slots__ = ("vocab", "_decoder")
+
+    def __init__(self, vocab: dict[int, bytes] | _VocabView):
+        self.vocab = vocab
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def push(self, token_id: int) -> str:
+        return self._decoder.decode(self.vocab[token_id])
+
+    def flush(self) -> str:
+        text = self._decoder.decode(b"", final=True)
+        self._decoder.reset()
+        return text
+
+
+# Set once per worker process by the pool initializer of ``encode_batch_array`` and ``encode_corpus``.
+_worker_tokenizer: tokenizer | None = None
+
+
+def _init_encode_worker(tok: tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tok
+
+
+def _encode_batch_worker(texts: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    return _worker_tokenizer._encode_flat(texts)
+
+
+def _call_with_worker_tokenizer(func, *args):
+    """Run ``func(tokenizer, *args)`` in a pool worker with the tokenizer set by ``_init_encode_worker``."""
+    return func(_worker_tokenizer, *args)
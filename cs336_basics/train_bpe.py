@@ -1,9 +1,50 @@
+import bisect
 import collections
+import glob
+import hashlib
 import heapq
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import resource
+import struct
+import sys
+import tempfile
+import time
+from array import array
+from collections.abc import Callable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+import numpy as np
+import psutil
 import regex
 
+from cs336_basics.pretokenization_example import find_chunk_boundaries
+
+logger = logging.getLogger(__name__)
+
 GPT2_SPLIT_PATTERN = r"'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"
 
+# Pair IDs pack (left, right) symbol IDs into one int: ``left << PAIR_SHIFT | right``.
+PAIR_SHIFT = 32
+PAIR_MASK = (1 << PAIR_SHIFT) - 1
+
+# Size of the file range handed to one pretokenization task.
+PRETOKENIZE_CHUNK_BYTES = 64 * 1024 * 1024
+
+FINGERPRINT_BLOCK_BYTES = 8 * 1024 * 1024
+
+# Word-count file header: magic, number of words, UTF-8 blob length, then the ``BoundedCounter`` state
+# (``max_types``, 0 for an exact count, ``dropped_count``, ``dropped_types``). Version 1 files end after
+# the blob length and are read as exact counts.
+_WORD_COUNTS_MAGIC = b"BPEWC\x00\x00\x02"
+_WORD_COUNTS_MAGIC_V1 = b"BPEWC\x00\x00\x01"
+_WORD_COUNTS_HEADER = struct.Struct("<8sQQQQQ")
+_WORD_COUNTS_HEADER_V1 = struct.Struct("<8sQQ")
+
 
 class _RevPair:
     """Wrapper so heapq breaks ties by *larger* pairs, matching reference merges."""
@@ -17,30 +58,894 @@ class _RevPair:
         return self.pair > other.pair
 
 
-def train_bpe(
+def _compile_special_pattern(special_tokens: list[str]):
+    if not special_tokens:
+        return None
+    escaped_tokens = [regex.escape(token) for token in special_tokens]
+    return regex.compile("(" + "|".join(escaped_tokens) + ")")
+
+
+@dataclass
+class TrainStats:
+    """
+    Metrics of one ``train_bpe`` run, returned with ``return_stats=True`` and passed to ``progress``.
+
+    ``phase_seconds`` holds wall time per phase (``read``, ``pretokenize``, ``load_cache``, ``word_table``,
+    ``replay``, ``pair_counts``, ``merge``). With parallel pretokenization reading happens in the workers
+    and is included in ``pretokenize``. ``timeline`` samples ``(seconds into the merge loop, merges done,
+    queue entries)`` every ``sample_every`` merges; queue entries include stale ones for the bytes engine.
+
+    ``peak_rss`` is the coordinator's high-water mark (``ru_maxrss``, so peaks between samples count
+    too). ``peak_rss_workers`` covers the worker processes: the largest total RSS of the live children
+    (e.g. the ``merge_workers`` shards) seen at a sample, or the high-water mark of the largest finished
+    child (e.g. a pretokenization worker) if that is higher. Both are process-wide high-water marks, so
+    run each measurement in a fresh process.
+    """
+
+    phase_seconds: dict[str, float] = field(default_factory=dict)
+    num_merges: int = 0
+    timeline: list[tuple[float, int, int]] = field(default_factory=list)
+    words_touched: array = field(default_factory=lambda: array("I"))
+    peak_rss: int = 0
+    peak_rss_workers: int = 0
+    dropped_count: int = 0
+    sample_every: int = 100
+    progress: Callable[["TrainStats"], None] | None = field(default=None, repr=False)
+    _last_lap: float = field(default_factory=time.perf_counter, repr=False)
+    _merge_start: float = field(default=0.0, repr=False)
+
+    def add_time(self, phase: str, seconds: float):
+        self.phase_seconds[phase] = self.phase_seconds.get(phase, 0.0) + seconds
+
+    def lap(self, phase: str):
+        """Charge the time since the previous lap to ``phase``."""
+        now = time.perf_counter()
+        self.add_time(phase, now - self._last_lap)
+        self._last_lap = now
+        self.sample_rss()
+        if self.progress is not None:
+            self.progress(self)
+
+    def sample_rss(self):
+        process = psutil.Process()
+        self.peak_rss = max(self.peak_rss, process.memory_info().rss, _max_rss(resource.RUSAGE_SELF))
+        live_workers = 0
+        for child in process.children(recursive=True):
+            try:
+                live_workers += child.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        self.peak_rss_workers = max(self.peak_rss_workers, live_workers, _max_rss(resource.RUSAGE_CHILDREN))
+
+    def start_merges(self, num_merges: int, queue_size: int):
+        self._merge_start = time.perf_counter()
+        self.num_merges = num_merges
+        self.timeline.append((0.0, num_merges, queue_size))
+
+    def record_merge(self, words_touched: int, queue_size: int):
+        self.num_merges += 1
+        self.words_touched.append(words_touched)
+        if self.num_merges % self.sample_every == 0:
+            self.timeline.append((time.perf_counter() - self._merge_start, self.num_merges, queue_size))
+            self.sample_rss()
+            if self.progress is not None:
+                self.progress(self)
+
+    def merges_per_second(self) -> list[tuple[float, float]]:
+        """Merge rate between consecutive ``timeline`` samples, as ``(seconds into the merge loop, rate)``."""
+        rates = []
+        for (t0, m0, _), (t1, m1, _) in zip(self.timeline, self.timeline[1:]):
+            if t1 > t0:
+                rates.append((t1, (m1 - m0) / (t1 - t0)))
+        return rates
+
+
+def _max_rss(who: int) -> int:
+    """``ru_maxrss`` in bytes (it is reported in KiB on Linux and in bytes on macOS)."""
+    max_rss = resource.getrusage(who).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def _timed_iter(iterable, metrics: TrainStats, phase: str):
+    """Yield from ``iterable``, charging the time spent producing each item to ``phase``."""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            metrics.add_time(phase, time.perf_counter() - start)
+            return
+        metrics.add_time(phase, time.perf_counter() - start)
+        yield item
+
+
+class BoundedCounter(collections.Counter):
+    """
+    Pre-token counter that holds at most ``max_types`` distinct words.
+
+    Whenever an update pushes it over budget, the rarest words are evicted until half the budget is
+    left (lossy counting). Frequent words survive with exact or slightly low counts; the evicted mass
+    is tracked in ``dropped_count`` (occurrences) and ``dropped_types`` (evicted entries).
+
+    Counts can only be added (``update``, ``+``, ``+=``), which sums the dropped mass too. Subtracting,
+    ``|`` and ``&`` raise ``TypeError``: the evicted counts are unknown, so their result would be wrong.
+    """
+
+    def __init__(self, iterable=None, /, *, max_types: int, **kwds):
+        self.max_types = max_types
+        self.dropped_count = 0
+        self.dropped_types = 0
+        super().__init__(iterable, **kwds)
+
+    def __reduce__(self):
+        return (_rebuild_bounded_counter, (self.max_types, dict(self), self.dropped_count, self.dropped_types))
+
+    def copy(self) -> "BoundedCounter":
+        return _rebuild_bounded_counter(self.max_types, self, self.dropped_count, self.dropped_types)
+
+    def update(self, iterable=None, /, **kwds):
+        super().update(iterable, **kwds)
+        self._absorb(iterable)
+
+    def _absorb(self, other):
+        """Take over the dropped mass of ``other`` and prune if over budget."""
+        if isinstance(other, BoundedCounter):
+            self.dropped_count += other.dropped_count
+            self.dropped_types += other.dropped_types
+        if len(self) > self.max_types:
+            self.prune(self.max_types // 2)
+
+    def __add__(self, other):
+        if not isinstance(other, collections.Counter):
+            return NotImplemented
+        result = self.copy()
+        result += other
+        return result
+
+    __radd__ = __add__
+
+    def __iadd__(self, other):
+        super().__iadd__(other)
+        self._absorb(other)
+        return self
+
+    def _not_additive(self, *args, **kwds):
+        raise TypeError("BoundedCounter only supports adding counts")
+
+    subtract = __sub__ = __rsub__ = __isub__ = _not_additive
+    __or__ = __ror__ = __ior__ = __and__ = __rand__ = __iand__ = _not_additive
+
+    def prune(self, target: int):
+        """Evict every word whose count is at or below the smallest threshold that leaves ``target`` words."""
+        histogram = collections.Counter(self.values())
+        remaining = len(self)
+        threshold = 0
+        for count in sorted(histogram):
+            if remaining <= target:
+                break
+            remaining -= histogram[count]
+            threshold = count
+        rare = [word for word, count in self.items() if count <= threshold]
+        for word in rare:
+            self.dropped_count += self.pop(word)
+        self.dropped_types += len(rare)
+
+    @property
+    def dropped_fraction(self) -> float:
+        total = sum(self.values()) + self.dropped_count
+        return self.dropped_count / total if total else 0.0
+
+
+def _rebuild_bounded_counter(max_types: int, counts: dict, dropped_count: int, dropped_types: int) -> BoundedCounter:
+    counter = BoundedCounter(max_types=max_types)
+    dict.update(counter, counts)
+    counter.dropped_count = dropped_count
+    counter.dropped_types = dropped_types
+    return counter
+
+
+def _new_word_counts(max_word_types: int | None) -> collections.Counter:
+    return collections.Counter() if max_word_types is None else BoundedCounter(max_types=max_word_types)
+
+
+def _count_pretokens(text: str, gpt2_pat, special_pat, special_tokens: list[str], word_counts: collections.Counter):
+    """Split ``text`` on special tokens, run the GPT-2 regex and add pre-token counts to ``word_counts``."""
+    parts = special_pat.split(text) if special_pat else [text]
+    for part in parts:
+        if not part or (special_tokens and part in special_tokens):
+            continue
+        word_counts.update(gpt2_pat.findall(part))
+
+
+def _count_file_range(
+    input_path: str, start: int, end: int, special_tokens: list[str], max_word_types: int | None = None
+) -> collections.Counter:
+    """Worker entry point: pre-token counts for the byte range ``[start, end)`` of ``input_path``."""
+    gpt2_pat = regex.compile(GPT2_SPLIT_PATTERN)
+    special_pat = _compile_special_pattern(special_tokens)
+    word_counts = _new_word_counts(max_word_types)
+    for view in iter_document_views(input_path, special_tokens[0], start=start, end=end, special_tokens=special_tokens):
+        _count_pretokens(str(view, "utf-8"), gpt2_pat, special_pat, special_tokens, word_counts)
+    return word_counts
+
+
+def pretokenize_parallel(
+    input_path: str, special_tokens: list[str], num_workers: int, max_word_types: int | None = None
+) -> collections.Counter:
+    """
+    Count pre-tokens of ``input_path`` in a process pool.
+
+    The file is cut at occurrences of the first special token (see ``find_chunk_boundaries``), so no
+    pre-token straddles two chunks and the reduced counts equal those of the serial path.
+    """
+    file_size = os.path.getsize(input_path)
+    desired_num_chunks = max(num_workers, -(-file_size // PRETOKENIZE_CHUNK_BYTES))
+    with open(input_path, "rb") as f:
+        boundaries = find_chunk_boundaries(f, desired_num_chunks, special_tokens[0].encode("utf-8"))
+
+    word_counts = _new_word_counts(max_word_types)
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        futures = [
+            pool.submit(_count_file_range, input_path, start, end, special_tokens, max_word_types)
+            for start, end in zip(boundaries[:-1], boundaries[1:])
+        ]
+        for future in futures:
+            word_counts.update(future.result())
+    return word_counts
+
+
+def pretokenize(
     input_path: str,
-    vocab_size: int,
     special_tokens: list[str],
-) -> tuple[dict[int, bytes], list[tuple[bytes, bytes]]]:
-    word_counts = collections.Counter()
+    num_workers: int = 1,
+    max_word_types: int | None = None,
+    metrics: TrainStats | None = None,
+) -> collections.Counter:
+    """
+    Count the pre-tokens (as ``str``) of ``input_path``, serially or in a process pool.
+
+    With ``max_word_types`` the counts are kept in a ``BoundedCounter`` (per worker and in the reduce),
+    trading exactness on rare words for a fixed memory budget. With ``metrics`` the serial path charges
+    time spent in the reader to the ``read`` phase.
+    """
+    if num_workers > 1 and special_tokens:
+        return pretokenize_parallel(input_path, special_tokens, num_workers, max_word_types)
+    word_counts = _new_word_counts(max_word_types)
     delimiter = special_tokens[0] if special_tokens else None
     gpt2_pat = regex.compile(GPT2_SPLIT_PATTERN)
+    special_pat = _compile_special_pattern(special_tokens)
+    chunks = read_chunks(input_path, separator=delimiter, special_tokens=special_tokens)
+    if metrics is not None:
+        chunks = _timed_iter(chunks, metrics, "read")
+    for text_chunk in chunks:
+        _count_pretokens(text_chunk, gpt2_pat, special_pat, special_tokens, word_counts)
+    return word_counts
+
+
+def corpus_fingerprint(input_path: str, special_tokens: list[str], max_word_types: int | None = None) -> str:
+    """
+    Hash of the corpus contents, the split pattern and the special tokens: the word-count cache key.
+    A counting budget changes the table, so it is part of the key when set.
+    """
+    h = hashlib.sha256()
+    with open(input_path, "rb") as f:
+        while block := f.read(FINGERPRINT_BLOCK_BYTES):
+            h.update(block)
+    h.update(b"\0" + GPT2_SPLIT_PATTERN.encode("utf-8"))
+    for token in special_tokens:
+        h.update(b"\0" + token.encode("utf-8"))
+    if max_word_types is not None:
+        h.update(f"\0max_word_types={max_word_types}".encode())
+    return h.hexdigest()
+
+
+def save_word_counts(word_counts: collections.Counter, path: str):
+    """
+    Write ``word_counts`` in a compact binary layout: a header, the counts as int64, the word lengths
+    (in characters) as uint32 and all words as one UTF-8 blob. The file is written atomically. The
+    dropped mass of a ``BoundedCounter`` is kept in the header.
+    """
+    words = list(word_counts)
+    counts = array("q", (word_counts[w] for w in words))
+    lengths = array("I", (len(w) for w in words))
+    blob = "".join(words).encode("utf-8")
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        if isinstance(word_counts, BoundedCounter):
+            bounded = (word_counts.max_types, word_counts.dropped_count, word_counts.dropped_types)
+        else:
+            bounded = (0, 0, 0)
+        f.write(_WORD_COUNTS_HEADER.pack(_WORD_COUNTS_MAGIC, len(words), len(blob), *bounded))
+        counts.tofile(f)
+        lengths.tofile(f)
+        f.write(blob)
+    os.replace(tmp_path, path)
+
+
+def load_word_counts(path: str) -> collections.Counter:
+    """Read a table written by ``save_word_counts``; a bounded table comes back as a ``BoundedCounter``."""
+    with open(path, "rb") as f:
+        magic = f.read(len(_WORD_COUNTS_MAGIC))
+        if magic == _WORD_COUNTS_MAGIC:
+            header = magic + f.read(_WORD_COUNTS_HEADER.size - len(magic))
+            _, num_words, blob_len, max_types, dropped_count, dropped_types = _WORD_COUNTS_HEADER.unpack(header)
+        elif magic == _WORD_COUNTS_MAGIC_V1:
+            header = magic + f.read(_WORD_COUNTS_HEADER_V1.size - len(magic))
+            _, num_words, blob_len = _WORD_COUNTS_HEADER_V1.unpack(header)
+            max_types = dropped_count = dropped_types = 0
+        else:
+            raise ValueError(f"{path} is not a word-count file")
+        counts = array("q")
+        counts.fromfile(f, num_words)
+        lengths = array("I")
+        lengths.fromfile(f, num_words)
+        text = f.read(blob_len).decode("utf-8")
+    word_counts: collections.Counter = collections.Counter()
+    pos = 0
+    for length, count in zip(lengths, counts):
+        word_counts[text[pos : pos + length]] = count
+        pos += length
+    if max_types:
+        return _rebuild_bounded_counter(max_types, word_counts, dropped_count, dropped_types)
+    return word_counts
+
+
+def expand_input_paths(input_path: str | os.PathLike | list[str | os.PathLike]) -> list[str]:
+    """Resolve a path, a glob pattern or a list of either to a list of files; patterns expand sorted."""
+    patterns = [input_path] if isinstance(input_path, (str, os.PathLike)) else list(input_path)
+    paths = []
+    for pattern in map(os.fspath, patterns):
+        if os.path.exists(pattern) or not any(c in pattern for c in "*?["):
+            paths.append(pattern)
+            continue
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise FileNotFoundError(f"No input files match {pattern!r}")
+        paths.extend(matches)
+    if not paths:
+        raise ValueError("No input files given")
+    return paths
+
+
+def _word_counts_path(directory: str, fingerprint: str) -> str:
+    return os.path.join(directory, f"word_counts-{fingerprint}.bin")
+
+
+def _combine_fingerprints(fingerprints: list[str]) -> str:
+    """The fingerprint of several files: the ``corpus_fingerprint`` of one, or a hash of all in order."""
+    if len(fingerprints) == 1:
+        return fingerprints[0]
+    return hashlib.sha256("\0".join(fingerprints).encode()).hexdigest()
+
+
+def count_shard(input_path: str, special_tokens: list[str], output_path: str, max_word_types: int | None = None) -> str:
+    """Map step: count the pre-tokens of one shard and write them to ``output_path`` (``save_word_counts``)."""
+    save_word_counts(pretokenize(input_path, special_tokens, max_word_types=max_word_types), output_path)
+    return output_path
 
-    if special_tokens:
-        escaped_tokens = [regex.escape(token) for token in special_tokens]
-        special_pat = regex.compile("(" + "|".join(escaped_tokens) + ")")
+
+def merge_word_counts(paths: list[str], max_word_types: int | None = None) -> collections.Counter:
+    """Reduce step: sum the partial counts written by ``count_shard``, including their dropped mass."""
+    word_counts = _new_word_counts(max_word_types)
+    for path in paths:
+        word_counts.update(load_word_counts(path))
+    return word_counts
+
+
+def pretokenize_shards(
+    input_paths: list[str],
+    special_tokens: list[str],
+    scratch_dir: str,
+    num_workers: int = 1,
+    max_word_types: int | None = None,
+    fingerprints: list[str] | None = None,
+) -> collections.Counter:
+    """
+    Map-reduce pre-token counting over many files.
+
+    Every shard's counts are written to ``scratch_dir`` under its ``corpus_fingerprint`` (the same name
+    the ``train_bpe`` cache uses) and shards whose partial file already exists are not recounted, so
+    after a failure only the missing shards run again. With ``num_workers > 1`` shards are counted in
+    a process pool; a shard that fails does not stop the others from finishing. ``fingerprints`` may
+    pass in the shards' ``corpus_fingerprint`` values when the caller already has them.
+    """
+    os.makedirs(scratch_dir, exist_ok=True)
+    if fingerprints is None:
+        fingerprints = [corpus_fingerprint(path, special_tokens, max_word_types) for path in input_paths]
+    partials = [_word_counts_path(scratch_dir, fingerprint) for fingerprint in fingerprints]
+    todo = [(path, partial) for path, partial in zip(input_paths, partials) if not os.path.exists(partial)]
+    if num_workers > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(max_workers=min(num_workers, len(todo))) as executor:
+            futures = [
+                executor.submit(count_shard, path, special_tokens, partial, max_word_types) for path, partial in todo
+            ]
+        for future, (path, _) in zip(futures, todo):
+            if future.exception() is not None:
+                raise RuntimeError(f"Counting pre-tokens of {path} failed") from future.exception()
     else:
-        special_pat = None
+        for path, partial in todo:
+            save_word_counts(pretokenize(path, special_tokens, num_workers, max_word_types), partial)
+    return merge_word_counts(partials, max_word_types)
+
+
+def save_training_state(
+    path: str,
+    merges: list[tuple[bytes, bytes]],
+    special_tokens: list[str],
+    corpus: str | None = None,
+    max_word_types: int | None = None,
+):
+    """
+    Atomically write a training snapshot (the merges learned so far) that ``train_bpe`` can resume from.
+    ``corpus`` (a ``corpus_fingerprint``) and ``max_word_types`` identify the run the merges belong to.
+    """
+    state = {
+        "version": 2,
+        "special_tokens": special_tokens,
+        "corpus": corpus,
+        "max_word_types": max_word_types,
+        "merges": [[list(first), list(second)] for first, second in merges],
+    }
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def load_training_state(
+    path: str,
+    special_tokens: list[str] | None = None,
+    corpus: str | None = None,
+    max_word_types: int | None = None,
+) -> list[tuple[bytes, bytes]]:
+    """
+    Read the merges from a snapshot written by ``save_training_state``. With ``corpus`` set, the snapshot
+    must come from a run on that corpus fingerprint with the same ``max_word_types``.
+    """
+    with open(path, encoding="utf-8") as f:
+        state = json.load(f)
+    if special_tokens is not None and state["special_tokens"] != special_tokens:
+        raise ValueError(
+            f"Snapshot {path} was trained with special tokens {state['special_tokens']!r}, not {special_tokens!r}"
+        )
+    if corpus is not None:
+        if state.get("max_word_types") != max_word_types:
+            raise ValueError(
+                f"Snapshot {path} was trained with max_word_types={state.get('max_word_types')}, not {max_word_types}"
+            )
+        if state.get("corpus") != corpus:
+            raise ValueError(f"Snapshot {path} was trained on a different corpus")
+    return [(bytes(first), bytes(second)) for first, second in state["merges"]]
+
+
+class _SymbolOrder:
+    """
+    Integer labels for symbols that preserve the byte order of the symbols themselves.
+
+    New symbols get the midpoint between their sorted neighbours' labels, so a pair's tie-break key is
+    a plain int: ``(label[left] << LABEL_BITS) | label[right]`` orders pairs exactly like comparing
+    ``(left_bytes, right_bytes)``. When a gap is exhausted every symbol is renumbered.
+    """
+
+    SPACING_BITS = 64
+    LABEL_BITS = SPACING_BITS + 32
+
+    def __init__(self, symbols: dict[int, bytes]):
+        order = sorted(symbols, key=symbols.__getitem__)
+        self._sorted_bytes = [symbols[i] for i in order]
+        self._sorted_ids = order
+        self.label: dict[int, int] = {}
+        self._renumber()
+
+    def _renumber(self):
+        for rank, sym_id in enumerate(self._sorted_ids, start=1):
+            self.label[sym_id] = rank << self.SPACING_BITS
+
+    def insert(self, sym_id: int, sym_bytes: bytes) -> bool:
+        """Label a new symbol. Returns True if existing labels were renumbered."""
+        pos = bisect.bisect(self._sorted_bytes, sym_bytes)
+        lo = self.label[self._sorted_ids[pos - 1]] if pos else 0
+        if pos < len(self._sorted_ids):
+            hi = self.label[self._sorted_ids[pos]]
+        else:
+            hi = lo + (2 << self.SPACING_BITS)
+        self._sorted_bytes.insert(pos, sym_bytes)
+        self._sorted_ids.insert(pos, sym_id)
+        if hi - lo < 2:
+            self._renumber()
+            return True
+        self.label[sym_id] = (lo + hi) >> 1
+        return False
+
+
+class _PairQueue:
+    """
+    Indexed binary max-heap with exactly one entry per pair.
+
+    Keys are ints; ``set`` moves an existing entry up or down in place instead of pushing a
+    duplicate, so the heap never holds stale entries.
+    """
+
+    __slots__ = ("_keys", "_items", "_pos")
+
+    def __init__(self, entries: dict[int, int]):
+        # A list sorted in descending order already satisfies the max-heap invariant.
+        ordered = sorted(entries.items(), key=lambda kv: kv[1], reverse=True)
+        self._items = [item for item, _ in ordered]
+        self._keys = [key for _, key in ordered]
+        self._pos = {item: i for i, item in enumerate(self._items)}
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, item: int) -> bool:
+        return item in self._pos
 
-    for text_chunk in read_chunks(input_path, separator=delimiter):
-        parts = special_pat.split(text_chunk) if special_pat else [text_chunk]
-        for part in parts:
-            if not part or (special_tokens and part in special_tokens):
+    def set(self, item: int, key: int):
+        pos = self._pos.get(item)
+        if pos is None:
+            self._items.append(item)
+            self._keys.append(key)
+            self._pos[item] = len(self._items) - 1
+            self._sift_up(len(self._items) - 1)
+            return
+        old_key = self._keys[pos]
+        self._keys[pos] = key
+        if key > old_key:
+            self._sift_up(pos)
+        elif key < old_key:
+            self._sift_down(pos)
+
+    def remove(self, item: int):
+        pos = self._pos.pop(item, None)
+        if pos is None:
+            return
+        last_item = self._items.pop()
+        last_key = self._keys.pop()
+        if pos == len(self._items):
+            return
+        old_key = self._keys[pos]
+        self._items[pos] = last_item
+        self._keys[pos] = last_key
+        self._pos[last_item] = pos
+        if last_key > old_key:
+            self._sift_up(pos)
+        else:
+            self._sift_down(pos)
+
+    def peek(self) -> tuple[int, int]:
+        return self._items[0], self._keys[0]
+
+    def _sift_up(self, pos: int):
+        items, keys, index = self._items, self._keys, self._pos
+        item, key = items[pos], keys[pos]
+        while pos:
+            parent = (pos - 1) >> 1
+            if keys[parent] >= key:
+                break
+            items[pos] = items[parent]
+            keys[pos] = keys[parent]
+            index[items[pos]] = pos
+            pos = parent
+        items[pos] = item
+        keys[pos] = key
+        index[item] = pos
+
+    def _sift_down(self, pos: int):
+        items, keys, index = self._items, self._keys, self._pos
+        n = len(items)
+        item, key = items[pos], keys[pos]
+        child = 2 * pos + 1
+        while child < n:
+            right = child + 1
+            if right < n and keys[right] > keys[child]:
+                child = right
+            if keys[child] <= key:
+                break
+            items[pos] = items[child]
+            keys[pos] = keys[child]
+            index[items[pos]] = pos
+            pos = child
+            child = 2 * pos + 1
+        items[pos] = item
+        keys[pos] = key
+        index[item] = pos
+
+
+class _WordShard:
+    """
+    A slice of the deduplicated word table for the ``"ids"`` engine.
+
+    The words live in one flat ``array("i")`` of symbol IDs (CSR layout): word ``k`` is
+    ``tokens[starts[k] : starts[k] + lengths[k]]`` and shrinks in place as merges apply. The pair -> word
+    index built by ``pair_counts`` is two sorted NumPy arrays (pair keys with offsets into a word-ID array);
+    pairs created later by a merge get an ``array("i")`` of word IDs in ``new_index``.
+
+    The coordinator owns the global pair counts and only sees the per-merge deltas returned by
+    ``apply_merge``, so one shard in-process and several shards in worker processes (``_ShardPool``)
+    run the same merge loop.
+    """
+
+    def __init__(self, words: list[str], counts: list[int]):
+        encoded = [word.encode("utf-8") for word in words]
+        lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+        starts = np.zeros(len(encoded), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=starts[1:])
+        self.tokens = array("i", np.frombuffer(b"".join(encoded), dtype=np.uint8).astype(np.int32).tobytes())
+        self.starts = array("q", starts.tobytes())
+        self.lengths = array("q", lengths.tobytes())
+        self.counts = counts
+        self.index_keys = np.empty(0, dtype=np.int64)
+        self.index_offsets = np.zeros(1, dtype=np.int64)
+        self.index_words = np.empty(0, dtype=np.int32)
+        self.new_index: dict[int, array] = {}
+        self.merged: set[int] = set()
+
+    def replay(self, ranks: dict[int, list[int]], new_ids: dict[int, int]):
+        tokens, starts, lengths = self.tokens, self.starts, self.lengths
+        for k in range(len(starts)):
+            start = starts[k]
+            word = _replay_merges(tokens[start : start + lengths[k]], ranks, new_ids)
+            tokens[start : start + len(word)] = word
+            lengths[k] = len(word)
+
+    def pair_counts(self) -> dict[int, int]:
+        """Count every adjacent pair, weighted by word count, and build the pair index."""
+        tokens = np.frombuffer(self.tokens, dtype=np.int32)
+        starts = np.frombuffer(self.starts, dtype=np.int64)
+        lengths = np.frombuffer(self.lengths, dtype=np.int64)
+        # One row per adjacency: position i pairs tokens[i] with tokens[i + 1] inside a word.
+        pairs_per_word = np.maximum(lengths - 1, 0)
+        word_ids = np.repeat(np.arange(len(starts), dtype=np.int32), pairs_per_word)
+        first = np.arange(len(word_ids), dtype=np.int64)
+        first += np.repeat(starts - np.cumsum(pairs_per_word) + pairs_per_word, pairs_per_word)
+        keys = (tokens[first].astype(np.int64) << PAIR_SHIFT) | tokens[first + 1]
+
+        # A stable sort keeps word IDs ascending within each pair, so repeats in a word are adjacent.
+        order = np.argsort(keys, kind="stable")
+        keys, word_ids = keys[order], word_ids[order]
+        if not len(keys):
+            return collections.defaultdict(int)
+        new_key = np.empty(len(keys), dtype=bool)
+        new_key[0] = True
+        np.not_equal(keys[1:], keys[:-1], out=new_key[1:])
+        key_starts = np.flatnonzero(new_key)
+        weights = np.asarray(self.counts, dtype=np.int64)[word_ids]
+        freqs = np.add.reduceat(weights, key_starts)
+
+        new_entry = new_key.copy()
+        new_entry[1:] |= word_ids[1:] != word_ids[:-1]
+        self.index_keys = keys[key_starts]
+        self.index_offsets = np.append(np.cumsum(new_entry)[key_starts] - 1, new_entry.sum())
+        self.index_words = word_ids[new_entry]
+        return collections.defaultdict(int, zip(self.index_keys.tolist(), freqs.tolist()))
+
+    def _words_with(self, pid: int) -> list[int]:
+        """Pop the IDs of the words that may contain pair ``pid``; stale entries are possible."""
+        word_ids = []
+        if pid not in self.merged:
+            self.merged.add(pid)
+            k = int(np.searchsorted(self.index_keys, pid))
+            if k < len(self.index_keys) and self.index_keys[k] == pid:
+                word_ids = self.index_words[self.index_offsets[k] : self.index_offsets[k + 1]].tolist()
+        extra = self.new_index.pop(pid, None)
+        if extra is not None:
+            word_ids.extend(extra)
+        return word_ids
+
+    def apply_merge(self, left: int, right: int, new_id: int) -> tuple[dict[int, int], int]:
+        """Merge ``(left, right)`` into ``new_id`` in every word; return the pair-count deltas and words touched."""
+        tokens, starts, lengths, counts_list = self.tokens, self.starts, self.lengths, self.counts
+        new_index = self.new_index
+        deltas: dict[int, int] = collections.defaultdict(int)
+
+        def add_to_index(new_pid: int, word_idx: int):
+            word_ids = new_index.get(new_pid)
+            if word_ids is None:
+                new_index[new_pid] = array("i", (word_idx,))
+            elif word_ids[-1] != word_idx:
+                word_ids.append(word_idx)
+
+        affected_indices = self._words_with((left << PAIR_SHIFT) | right)
+        for word_idx in affected_indices:
+            start = starts[word_idx]
+            n = start + lengths[word_idx]
+            w_count = counts_list[word_idx]
+
+            try:
+                i = tokens.index(left, start, n)
+            except ValueError:
+                # the index is never pruned, so the word may no longer contain the pair
                 continue
-            for word_str in gpt2_pat.findall(part):
-                word_bytes = word_str.encode("utf-8")
-                word_tuple = tuple(bytes([b]) for b in word_bytes)
-                word_counts[word_tuple] += 1
+            # Rewrite in place: the merged word is never longer, so writes (w) trail reads (i).
+            w = i
+            while i < n:
+                if tokens[i] == left and i < n - 1 and tokens[i + 1] == right:
+                    # update left neighbor stats
+                    if w > start:
+                        prev_token = tokens[w - 1]
+                        new_pid = (prev_token << PAIR_SHIFT) | new_id
+                        deltas[(prev_token << PAIR_SHIFT) | left] -= w_count
+                        deltas[new_pid] += w_count
+                        add_to_index(new_pid, word_idx)
+
+                    # update right neighbor stats
+                    if i + 2 < n:
+                        next_token = tokens[i + 2]
+                        new_pid = (new_id << PAIR_SHIFT) | next_token
+                        deltas[(right << PAIR_SHIFT) | next_token] -= w_count
+                        deltas[new_pid] += w_count
+                        add_to_index(new_pid, word_idx)
+
+                    tokens[w] = new_id
+                    i += 2
+                else:
+                    tokens[w] = tokens[i]
+                    i += 1
+                w += 1
+            lengths[word_idx] = w - start
+        return deltas, len(affected_indices)
+
+    def close(self):
+        pass
+
+
+def _shard_worker(conn, words: list[str], counts: list[int]):
+    """Serve ``_WordShard`` calls from a ``_ShardPool`` until told to stop."""
+    shard = _WordShard(words, counts)
+    while True:
+        method, args = conn.recv()
+        if method is None:
+            break
+        conn.send(getattr(shard, method)(*args))
+    conn.close()
+
+
+class _ShardPool:
+    """
+    The word table split round-robin over ``num_shards`` worker processes.
+
+    Same interface as ``_WordShard``: each call is broadcast to every worker and the results are summed.
+    Pair-count deltas are additive, so the coordinator sees exactly the counts a single shard would.
+    """
+
+    def __init__(self, words: list[str], counts: list[int], num_shards: int):
+        ctx = multiprocessing.get_context()
+        self._conns = []
+        self._processes = []
+        for k in range(num_shards):
+            conn, child_conn = ctx.Pipe()
+            process = ctx.Process(
+                target=_shard_worker, args=(child_conn, words[k::num_shards], counts[k::num_shards]), daemon=True
+            )
+            process.start()
+            child_conn.close()
+            self._conns.append(conn)
+            self._processes.append(process)
+
+    def _broadcast(self, method: str, *args) -> list:
+        for conn in self._conns:
+            conn.send((method, args))
+        return [conn.recv() for conn in self._conns]
+
+    def replay(self, ranks: dict[int, list[int]], new_ids: dict[int, int]):
+        self._broadcast("replay", ranks, new_ids)
+
+    def pair_counts(self) -> dict[int, int]:
+        stats: dict[int, int] = collections.defaultdict(int)
+        for part in self._broadcast("pair_counts"):
+            for pid, freq in part.items():
+                stats[pid] += freq
+        return stats
+
+    def apply_merge(self, left: int, right: int, new_id: int) -> tuple[dict[int, int], int]:
+        parts = self._broadcast("apply_merge", left, right, new_id)
+        deltas, touched = parts[0]
+        deltas = collections.defaultdict(int, deltas)
+        for part, part_touched in parts[1:]:
+            for pid, delta in part.items():
+                deltas[pid] += delta
+            touched += part_touched
+        return deltas, touched
+
+    def close(self):
+        for conn in self._conns:
+            try:
+                conn.send((None, ()))
+            except OSError:
+                pass
+            conn.close()
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+
+def train_bpe(
+    input_path: str | os.PathLike | list[str | os.PathLike],
+    vocab_size: int,
+    special_tokens: list[str],
+    num_workers: int = 1,
+    engine: str = "ids",
+    cache_dir: str | None = None,
+    initial_merges: list[tuple[bytes, bytes]] | None = None,
+    checkpoint_path: str | None = None,
+    checkpoint_every: int = 1000,
+    max_word_types: int | None = None,
+    merge_workers: int = 1,
+    progress: Callable[[TrainStats], None] | None = None,
+    return_stats: bool = False,
+):
+    """
+    Train a byte-level BPE tokenizer on ``input_path``: a file, a glob pattern or a list of either.
+
+    With ``num_workers > 1`` (and at least one special token to split documents on) pretokenization
+    runs in a process pool; the resulting merges are identical to the serial path.
+
+    ``engine`` selects the merge loop: ``"ids"`` (default) works on integer symbol IDs, ``"bytes"`` is
+    the original loop over ``bytes`` symbols. Both produce identical vocab and merges.
+
+    With ``cache_dir`` set, the pre-token counts are stored there under ``corpus_fingerprint`` and
+    later runs on the same corpus and special tokens skip pretokenization entirely. Several input files
+    are counted map-reduce style by ``pretokenize_shards``, with ``cache_dir`` (or a temporary
+    directory) holding the per-shard counts.
+
+    ``initial_merges`` warm-starts training: the merges are replayed over the word table in one bulk
+    pass (see ``_replay_merges``) and merging continues until ``vocab_size``. With ``checkpoint_path``
+    the merges are saved every ``checkpoint_every`` merges; if the file already exists training resumes
+    from it. A snapshot from another corpus or ``max_word_types``, or one that disagrees with
+    ``initial_merges``, raises ``ValueError``. Both require the ``"ids"`` engine.
+
+    ``max_word_types`` bounds the number of distinct pre-tokens held while counting (see
+    ``BoundedCounter``); the dropped mass is logged. Merges may then differ from an exact count, mostly
+    in the rare tail.
+
+    ``merge_workers > 1`` splits the word table over that many processes that apply each merge to their
+    shard and report pair-count deltas back; merges are identical to ``merge_workers=1``. It pays off on
+    large word tables, where early merges rewrite hundreds of thousands of words ("ids" engine only).
+
+    ``progress`` is called with a live ``TrainStats`` after each phase and every few hundred merges;
+    with ``return_stats=True`` the result is ``(vocab, merges, stats)`` instead of ``(vocab, merges)``.
+    """
+    metrics = TrainStats(progress=progress)
+    input_paths = expand_input_paths(input_path)
+    cache_path = fingerprint = file_fingerprints = None
+    # Hash every file at most once: sharded counting, the cache and the snapshot all key on it.
+    if checkpoint_path is not None or cache_dir is not None or len(input_paths) > 1:
+        file_fingerprints = [corpus_fingerprint(path, special_tokens, max_word_types) for path in input_paths]
+        fingerprint = _combine_fingerprints(file_fingerprints)
+    if cache_dir is not None and len(input_paths) == 1:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_path = _word_counts_path(cache_dir, fingerprint)
+    if cache_path is not None and os.path.exists(cache_path):
+        word_counts = load_word_counts(cache_path)
+        metrics.lap("load_cache")
+    else:
+        if len(input_paths) > 1:
+            with tempfile.TemporaryDirectory() as scratch_dir:
+                word_counts = pretokenize_shards(
+                    input_paths,
+                    special_tokens,
+                    cache_dir or scratch_dir,
+                    num_workers,
+                    max_word_types,
+                    fingerprints=file_fingerprints,
+                )
+        else:
+            word_counts = pretokenize(input_paths[0], special_tokens, num_workers, max_word_types, metrics)
+        metrics.lap("pretokenize")
+        metrics.phase_seconds["pretokenize"] -= metrics.phase_seconds.get("read", 0.0)
+        if cache_path is not None:
+            save_word_counts(word_counts, cache_path)
+    if isinstance(word_counts, BoundedCounter):
+        metrics.dropped_count = word_counts.dropped_count
+        logger.info(
+            "Bounded counting dropped %d pre-token occurrences (%.4f%% of the corpus) in %d evictions",
+            word_counts.dropped_count,
+            100 * word_counts.dropped_fraction,
+            word_counts.dropped_types,
+        )
 
     vocab: dict[int, bytes] = {}
     for i in range(256):
@@ -48,13 +953,59 @@ def train_bpe(
     for token in special_tokens:
         vocab[len(vocab)] = token.encode("utf-8")
 
+    saved_merges: list[tuple[bytes, bytes]] = []
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        saved_merges = load_training_state(checkpoint_path, special_tokens, fingerprint, max_word_types)
+        common = min(len(saved_merges), len(initial_merges or []))
+        if initial_merges and saved_merges[:common] != initial_merges[:common]:
+            raise ValueError(f"initial_merges do not agree with the merges in snapshot {checkpoint_path}")
+        if len(saved_merges) >= len(initial_merges or []):
+            initial_merges = saved_merges
+
+    def checkpoint(merges: list[tuple[bytes, bytes]]):
+        # A run with a smaller vocab_size must not replace a longer snapshot with its prefix.
+        if checkpoint_path is not None and len(merges) >= len(saved_merges):
+            save_training_state(checkpoint_path, merges, special_tokens, fingerprint, max_word_types)
+
+    if engine == "ids":
+        merges = _merge_ids(
+            word_counts,
+            vocab,
+            vocab_size,
+            initial_merges=initial_merges or [],
+            checkpoint=checkpoint,
+            checkpoint_every=checkpoint_every,
+            metrics=metrics,
+            merge_workers=merge_workers,
+        )
+    elif engine == "bytes":
+        if initial_merges or checkpoint_path is not None or merge_workers > 1:
+            raise ValueError("initial_merges, checkpoint_path and merge_workers require engine='ids'")
+        merges = _merge_bytes(word_counts, vocab, vocab_size, metrics)
+    else:
+        raise ValueError(f"Unknown BPE engine {engine!r}, expected 'ids' or 'bytes'")
+
+    if return_stats:
+        return vocab, merges, metrics
+    return vocab, merges
+
+
+def _merge_bytes(
+    word_counts: collections.Counter,
+    vocab: dict[int, bytes],
+    vocab_size: int,
+    metrics: TrainStats | None = None,
+) -> list[tuple[bytes, bytes]]:
+    """Reference merge loop: every symbol is a ``bytes`` object. Appends new tokens to ``vocab``."""
+    metrics = metrics or TrainStats()
     merges: list[tuple[bytes, bytes]] = []
 
     words_list: list[list[bytes]] = []
     counts_list: list[int] = []
-    for word_tuple, count in word_counts.items():
-        words_list.append(list(word_tuple))
+    for word_str, count in word_counts.items():
+        words_list.append([bytes([b]) for b in word_str.encode("utf-8")])
         counts_list.append(count)
+    metrics.lap("word_table")
 
     stats: dict[tuple[bytes, bytes], int] = collections.defaultdict(int)
     indices: dict[tuple[bytes, bytes], set[int]] = collections.defaultdict(set)
@@ -67,6 +1018,8 @@ def train_bpe(
 
     heap: list[tuple[int, _RevPair]] = [(-freq, _RevPair(pair)) for pair, freq in stats.items()]
     heapq.heapify(heap)
+    metrics.lap("pair_counts")
+    metrics.start_merges(0, len(heap))
 
     while len(vocab) < vocab_size:
         if not heap:
@@ -128,31 +1081,250 @@ def train_bpe(
 
         stats.pop(pair, None)
         indices.pop(pair, None)
+        metrics.record_merge(len(affected_indices), len(heap))
 
-    return vocab, merges
+    metrics.lap("merge")
+    return merges
+
+
+def _merge_ids(
+    word_counts: collections.Counter,
+    vocab: dict[int, bytes],
+    vocab_size: int,
+    initial_merges: list[tuple[bytes, bytes]] = (),
+    checkpoint=None,
+    checkpoint_every: int = 1000,
+    metrics: TrainStats | None = None,
+    merge_workers: int = 1,
+) -> list[tuple[bytes, bytes]]:
+    """
+    Merge loop over integer symbol IDs. Appends new tokens to ``vocab``.
+
+    Words are rows of symbol IDs in one flat ``array("i")`` (see ``_WordShard``) and pairs are packed into a single int
+    (``left << PAIR_SHIFT | right``), so rewriting words allocates no ``bytes`` objects. A symbol's ID is the
+    vocab ID under which its bytes first appeared; a merge that reproduces existing bytes reuses that
+    ID, so pairs compare exactly as the ``bytes`` engine compares them.
+
+    ``initial_merges`` are replayed first; ``checkpoint(merges)`` is called every ``checkpoint_every``
+    merges and once at the end. With ``merge_workers > 1`` the word table is split over that many
+    worker processes (``_ShardPool``); this loop keeps the pair counts and queue and picks every merge.
+    """
+    metrics = metrics or TrainStats()
+    symbol_bytes: dict[int, bytes] = {i: vocab[i] for i in range(256)}
+    symbol_ids: dict[bytes, int] = {b: i for i, b in symbol_bytes.items()}
+    merges: list[tuple[bytes, bytes]] = []
+
+    words = list(word_counts)
+    counts = [word_counts[word] for word in words]
+    shards = _WordShard(words, counts) if merge_workers <= 1 else _ShardPool(words, counts, merge_workers)
+    del words, counts
+    metrics.lap("word_table")
+    try:
+        if initial_merges:
+            replay_ranks: dict[int, list[int]] = collections.defaultdict(list)
+            replay_ids: dict[int, int] = {}
+            for rank, (first, second) in enumerate(initial_merges[: max(vocab_size - len(vocab), 0)]):
+                left, right = symbol_ids.get(first), symbol_ids.get(second)
+                if left is None or right is None:
+                    raise ValueError(f"Merge {rank} {(first, second)!r} uses a symbol no earlier merge produced")
+                new_bytes = first + second
+                new_id = symbol_ids.setdefault(new_bytes, len(vocab))
+                symbol_bytes[new_id] = new_bytes
+                vocab[len(vocab)] = new_bytes
+                merges.append((first, second))
+                pid = (left << PAIR_SHIFT) | right
+                replay_ranks[pid].append(rank)
+                replay_ids[pid] = new_id
+            shards.replay(replay_ranks, replay_ids)
+            metrics.lap("replay")
+
+        stats = shards.pair_counts()
+
+        # Queue keys are (freq, left label, right label) packed into one int: the highest frequency
+        # wins and ties go to the lexicographically larger pair, like ``_RevPair`` in the bytes engine.
+        order = _SymbolOrder(symbol_bytes)
+        label = order.label
+        label_bits = _SymbolOrder.LABEL_BITS
+        freq_shift = 2 * label_bits
 
+        def queue_key(pid: int, freq: int) -> int:
+            return (freq << freq_shift) | (label[pid >> PAIR_SHIFT] << label_bits) | label[pid & PAIR_MASK]
 
-def read_chunks(file_path, chunk_size=1024 * 1024, separator="<|endoftext|>"):
-    with open(file_path, "r", encoding="utf-8") as f:
-        buffer = ""
-        while True:
-            chunk = f.read(chunk_size)
-            if not chunk:
+        queue = _PairQueue({pid: queue_key(pid, freq) for pid, freq in stats.items() if freq > 0})
+        metrics.lap("pair_counts")
+        metrics.start_merges(len(merges), len(queue))
+
+        while len(vocab) < vocab_size and queue:
+            pid, key = queue.peek()
+            if key >> freq_shift < 1:
                 break
+            queue.remove(pid)
+
+            left, right = pid >> PAIR_SHIFT, pid & PAIR_MASK
+            new_bytes = symbol_bytes[left] + symbol_bytes[right]
+            new_id = symbol_ids.setdefault(new_bytes, len(vocab))
+            relabeled = False
+            if new_id not in symbol_bytes:
+                symbol_bytes[new_id] = new_bytes
+                relabeled = order.insert(new_id, new_bytes)
+            vocab[len(vocab)] = new_bytes
+            merges.append((symbol_bytes[left], symbol_bytes[right]))
+
+            deltas, words_touched = shards.apply_merge(left, right, new_id)
+            for p, delta in deltas.items():
+                stats[p] += delta
+            stats.pop(pid, None)
+            deltas.pop(pid, None)
+
+            if relabeled:
+                queue = _PairQueue({p: queue_key(p, freq) for p, freq in stats.items() if freq > 0})
+            else:
+                for p in deltas:
+                    freq = stats[p]
+                    if freq > 0:
+                        queue.set(p, queue_key(p, freq))
+                    else:
+                        queue.remove(p)
+            metrics.record_merge(words_touched, len(queue))
+
+            if checkpoint is not None and len(merges) % checkpoint_every == 0:
+                checkpoint(merges)
+    finally:
+        shards.close()
+
+    if checkpoint is not None:
+        checkpoint(merges)
+    metrics.lap("merge")
+    return merges
+
+
+def _replay_merges(word: array, ranks: dict[int, list[int]], new_ids: dict[int, int]) -> array:
+    """
+    Apply already-learned merges to one word exactly as the training loop applied them.
+
+    Merge ``r`` only rewrites adjacencies that existed when it was learned: every symbol remembers the
+    rank that created it, and a pair is merged by the first of its ranks (``ranks`` is ascending per
+    pair) that is later than both of its symbols. Equal ranks resolve left to right.
+    """
+    n = len(word)
+    if n < 2:
+        return word
+    symbols = list(word)
+    born = [-1] * n
+    nxt = list(range(1, n + 1))
+    nxt[-1] = -1
+    prev = list(range(-1, n - 1))
+
+    def candidate(i: int):
+        j = nxt[i]
+        if j == -1:
+            return None
+        pair_ranks = ranks.get((symbols[i] << PAIR_SHIFT) | symbols[j])
+        if pair_ranks is None:
+            return None
+        k = bisect.bisect_right(pair_ranks, max(born[i], born[j]))
+        return pair_ranks[k] if k < len(pair_ranks) else None
+
+    heap = []
+    for i in range(n - 1):
+        rank = candidate(i)
+        if rank is not None:
+            heap.append((rank, i))
+    heapq.heapify(heap)
 
-            buffer += chunk
+    while heap:
+        rank, i = heapq.heappop(heap)
+        if symbols[i] is None or candidate(i) != rank:
+            continue
+        j = nxt[i]
+        symbols[i] = new_ids[(symbols[i] << PAIR_SHIFT) | symbols[j]]
+        born[i] = rank
+        symbols[j] = None
+        nxt[i] = nxt[j]
+        if nxt[i] != -1:
+            prev[nxt[i]] = i
+        for k in (prev[i], i):
+            if k != -1:
+                next_rank = candidate(k)
+                if next_rank is not None:
+                    heapq.heappush(heap, (next_rank, k))
+
+    return array("i", (sym for sym in symbols if sym is not None))
+
+
+def _safe_cut(buf, target: int, end: int, special_tokens: list[bytes] = ()) -> int:
+    """
+    First position in ``[target, end)`` where the GPT-2 pattern is guaranteed to start a new pre-token:
+    an ASCII space between two printable ASCII characters that is not inside one of ``special_tokens``.
+    Returns ``end`` if there is none.
+    """
+    # Only special tokens that contain a space can straddle a cut.
+    spaced = [token for token in special_tokens if b" " in token]
+    pos = target
+    while True:
+        pos = buf.find(b" ", pos, end - 1)
+        if pos == -1:
+            return end
+        if 0x21 <= buf[pos - 1] <= 0x7E and 0x21 <= buf[pos + 1] <= 0x7E and not _straddles(buf, pos, spaced):
+            return pos
+        pos += 1
+
+
+def _straddles(buf, cut: int, special_tokens: list[bytes]) -> bool:
+    """Whether an occurrence of one of ``special_tokens`` starts before ``cut`` and ends after it."""
+    for token in special_tokens:
+        # ``find`` returns the leftmost match in the window, so a straddling one is found if it exists.
+        found = buf.find(token, max(cut - len(token) + 1, 0), cut + len(token))
+        if found != -1 and found < cut:
+            return True
+    return False
+
+
+def iter_document_views(
+    file_path,
+    separator: str | None = "<|endoftext|>",
+    chunk_size: int = 1024 * 1024,
+    start: int = 0,
+    end: int | None = None,
+    special_tokens: list[str] | None = None,
+) -> Iterator[memoryview]:
+    """
+    Yield zero-copy ``memoryview`` slices of a memory-mapped file, one per document.
 
+    Documents are the byte ranges between occurrences of ``separator`` within ``[start, end)``.
+    Documents longer than ``chunk_size`` bytes are cut further, but only at positions that cannot change
+    the GPT-2 pre-tokenization or split one of ``special_tokens`` (see ``_safe_cut``), so peak memory
+    does not depend on document size.
+    Each view is released once the consumer asks for the next one.
+    """
+    with open(file_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size if end is None else end
+        if size <= start:
+            return
+        sep = separator.encode("utf-8") if separator is not None else None
+        specials = [token.encode("utf-8") for token in special_tokens or ()]
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            pos = start
             while True:
-                try:
-                    if separator is None:
-                        yield buffer
-                        buffer = ""
+                found = mm.find(sep, pos, size) if sep else -1
+                doc_end = size if found == -1 else found
+                if found == -1 and pos == size:
+                    break
+                while doc_end - pos > chunk_size:
+                    cut = _safe_cut(mm, pos + chunk_size, doc_end, specials)
+                    if cut == doc_end:
                         break
-
-                    part, buffer = buffer.split(separator, 1)
-                    yield part
-                except ValueError:
+                    with view[pos:cut] as piece:
+                        yield piece
+                    pos = cut
+                with view[pos:doc_end] as piece:
+                    yield piece
+                if found == -1:
                     break
+                pos = found + len(sep)
+
 
-        if buffer:
-            yield buffer
+def read_chunks(file_path, chunk_size=1024 * 1024, separator="<|endoftext|>", special_tokens=None):
+    """Yield the documents of ``file_path`` as ``str``, each decoded once from the memory-mapped bytes."""
+    for view in iter_document_views(file_path, separator, chunk_size, special_tokens=special_tokens):
+        yield str(view, "utf-8")
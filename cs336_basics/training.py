@@ -16,6 +16,7 @@ def save_vocab(vocab: dict[int, bytes], filepath: str):
         json.dump(vocab_to_save, f)
 
 def save_merges(merges: list[tuple[bytes, bytes]], filepath: str):
+    skipped = 0
     with open(filepath, 'w', encoding='utf-8') as f:
         for b1, b2 in merges:
 
@@ -24,7 +25,15 @@ def save_merges(merges: list[tuple[bytes, bytes]], filepath: str):
                 s2 = b2.decode("utf-8")
                 f.write(f"{s1} {s2}\n")
             except UnicodeDecodeError:
-                pass
+                skipped += 1
+    if skipped:
+        print(f"Warning: {skipped} merges are not valid UTF-8 and were left out of {filepath}; "
+              "use save_tokenizer for a lossless copy")
+
+def save_tokenizer(vocab: dict[int, bytes], merges: list[tuple[bytes, bytes]], special_tokens: list[str],
+                   filepath: str):
+    """Write vocab, merges and special tokens as one binary artifact (see ``tokenizer.save``)."""
+    tokenizer(vocab, merges, special_tokens).save(filepath)
 
 def ReservoirSample(stream, k):
 
@@ -73,9 +82,9 @@ def get_sample_docs(file_path: str, num_docs: int = 10, separator: str = "<|endo
 
     return ReservoirSample(filtered_iterator, num_docs)
 
-def evaluate_tokenizer(vocab_path, merges_path, sample_docs):
+def evaluate_tokenizer(artifact_path, sample_docs):
 
-    tok = tokenizer.from_file(vocab_path, merges_path, special_tokens=["<|endoftext|>"])
+    tok = tokenizer.from_artifact(artifact_path)
 
     total_bytes = 0
     total_tokens = 0
@@ -103,44 +112,55 @@ if __name__ == "__main__":
     
     # Define absolute paths for data and output files
     data_dir = os.path.join(project_root, "data")
+    cache_dir = os.path.join(data_dir, "bpe_cache")
     
     owt_input_path = os.path.join(data_dir, "owt_train.txt")
     owt_vocab_path = os.path.join(data_dir, "owt_vocab.json")
     owt_merges_path = os.path.join(data_dir, "owt_merges.txt")
+    owt_state_path = os.path.join(data_dir, "owt_bpe_state.json")
+    owt_tokenizer_path = os.path.join(data_dir, "owt_tokenizer.bpetok")
     
     tiny_input_path = os.path.join(data_dir, "TinyStoriesV2-GPT4-train.txt")
     tiny_vocab_path = os.path.join(data_dir, "TinyStoriesV2-GPT4-vocab.json")
     tiny_merges_path = os.path.join(data_dir, "TinyStoriesV2-GPT4-merges.txt")
+    tiny_tokenizer_path = os.path.join(data_dir, "TinyStoriesV2-GPT4-tokenizer.bpetok")
 
     print(f"Training OWT tokenizer from {owt_input_path}...")
     owt_vocab, owt_merges = train_bpe(
         input_path = owt_input_path,
         vocab_size = 10000,
-        special_tokens = ["<|endoftext|>"]
+        special_tokens = ["<|endoftext|>"],
+        num_workers = os.cpu_count() or 1,
+        cache_dir = cache_dir,
+        checkpoint_path = owt_state_path,
     )
 
     save_vocab(owt_vocab, owt_vocab_path)
     save_merges(owt_merges, owt_merges_path)
+    save_tokenizer(owt_vocab, owt_merges, ["<|endoftext|>"], owt_tokenizer_path)
 
     print(f"Training TinyStories tokenizer from {tiny_input_path}...")
     Tiny_vocab, Tiny_merges = train_bpe(
         input_path = tiny_input_path,
         vocab_size = 32000,
-        special_tokens=["<|endoftext|>"]
+        special_tokens=["<|endoftext|>"],
+        num_workers = os.cpu_count() or 1,
+        cache_dir = cache_dir,
     )
 
     save_vocab(Tiny_vocab, tiny_vocab_path)
     save_merges(Tiny_merges, tiny_merges_path)
+    save_tokenizer(Tiny_vocab, Tiny_merges, ["<|endoftext|>"], tiny_tokenizer_path)
 
     print("Sampling documents for evaluation...")
     owt_docs = get_sample_docs(owt_input_path, num_docs=10)
     Tiny_docs = get_sample_docs(tiny_input_path, num_docs=10)
 
     print("Evaluating OWT tokenizer...")
-    ratio_owt = evaluate_tokenizer(owt_vocab_path, owt_merges_path, owt_docs)
+    ratio_owt = evaluate_tokenizer(owt_tokenizer_path, owt_docs)
     
     print("Evaluating TinyStories tokenizer...")
-    ratio_Tiny = evaluate_tokenizer(tiny_vocab_path, tiny_merges_path, Tiny_docs)
+    ratio_Tiny = evaluate_tokenizer(tiny_tokenizer_path, Tiny_docs)
 
     print(f"OWT Tokenizer Bytes per Token: {ratio_owt:.4f}")
     print(f"TinyStoriesV2-GPT4 Tokenizer Bytes per Token: {ratio_Tiny:.4f}")
@@ -34,3 +34,8 @@ try:
 except Exception as e:
     print(f"Error: {e}")
 
+
+# Streaming: the partial byte is held back until the token that completes it arrives
+print("\nWith decode_stream:")
+stream = t.decode_stream()
+print(f"push(0) -> {stream.push(0)!r}, push(1) -> {stream.push(1)!r}, flush() -> {stream.flush()!r}")
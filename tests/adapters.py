@@ -597,4 +597,5 @@ def run_train_bpe(
         input_path=input_path,
         vocab_size=vocab_size,
         special_tokens=special_tokens,
+        **kwargs,
     )
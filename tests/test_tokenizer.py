@@ -2,13 +2,17 @@ from __future__ import annotations
 
 import json
 import os
+import pickle
 import resource
 import sys
 
+import numpy as np
 import psutil
 import pytest
 import tiktoken
 
+from cs336_basics.encode_corpus import encode_corpus
+
 from .adapters import get_tokenizer
 from .common import FIXTURES_PATH, gpt2_bytes_to_unicode
 
@@ -462,3 +466,279 @@ def _encode(tokenizer, text):
     for just this function. We set the memory limit to 1MB.
     """
     return tokenizer.encode(text)
+
+
+def test_artifact_roundtrip(tmp_path):
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH,
+        merges_path=MERGES_PATH,
+        special_tokens=["<|endoftext|>", "<|endoftext|><|endoftext|>"],
+    )
+    # GPT-2 has byte-level merges that are not valid UTF-8; the artifact must keep them.
+    assert any(first.decode("utf-8", errors="ignore").encode("utf-8") != first for first, _ in tokenizer.merges)
+    artifact_path = tmp_path / "gpt2.bpetok"
+    tokenizer.save(artifact_path)
+    loaded = type(tokenizer).from_artifact(artifact_path)
+    assert loaded.vocab == tokenizer.vocab
+    assert loaded.merges == tokenizer.merges
+    assert loaded.special_tokens == tokenizer.special_tokens
+
+    test_string = "Héllò hôw <|endoftext|><|endoftext|> are ü? 🙃<|endoftext|>"
+    assert loaded.encode(test_string) == tokenizer.encode(test_string)
+
+    with open(artifact_path, "r+b") as f:
+        f.write(b"NOTATOK!")
+    with pytest.raises(ValueError):
+        type(tokenizer).from_artifact(artifact_path)
+
+
+def test_pretoken_cache():
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH,
+        merges_path=MERGES_PATH,
+        special_tokens=["<|endoftext|>"],
+    )
+    with open(FIXTURES_PATH / "tinystories_sample.txt") as f:
+        corpus_contents = f.read()
+    uncached = type(tokenizer)(tokenizer.vocab, tokenizer.merges, tokenizer.special_tokens, cache_size=0)
+    expected = uncached.encode(corpus_contents)
+    assert len(uncached.cache) == 0
+
+    tokenizer.cache_size = 64
+    assert tokenizer.encode(corpus_contents) == expected
+    assert len(tokenizer.cache) == 64
+    assert tokenizer.cache_hits > tokenizer.cache_misses
+    assert tokenizer.cache_hits + tokenizer.cache_misses == uncached.cache_misses
+    assert list(tokenizer.encode_iterable(corpus_contents.splitlines(keepends=True))) == expected
+
+
+def test_encode_batch_matches_encode():
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH,
+        merges_path=MERGES_PATH,
+        special_tokens=["<|endoftext|>"],
+    )
+    with open(FIXTURES_PATH / "tinystories_sample.txt") as f:
+        docs = f.read().split("<|endoftext|>")
+    docs += ["", "Héllò hôw <|endoftext|> are ü? 🙃"]
+    expected = [tokenizer.encode(doc) for doc in docs]
+
+    assert tokenizer.encode_batch(docs) == expected
+    assert tokenizer.encode_batch(docs, num_workers=2) == expected
+    ids, offsets = tokenizer.encode_batch_array(docs, num_workers=2)
+    assert offsets[0] == 0 and offsets[-1] == len(ids)
+    assert [ids[a:b].tolist() for a, b in zip(offsets, offsets[1:])] == expected
+
+
+def test_many_overlapping_special_tokens():
+    special_tokens = ["<|end", "<|endoftext|>", "[x]", "<|endoftext|><|endoftext|>", "|"]
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH,
+        merges_path=MERGES_PATH,
+        special_tokens=special_tokens,
+    )
+    test_string = "a<|endoftext|><|endoftext|><|endoftext|><|end|of[x]"
+    tokenized_string = [tokenizer.decode([x]) for x in tokenizer.encode(test_string)]
+    assert tokenized_string == ["a", "<|endoftext|><|endoftext|>", "<|endoftext|>", "<|end", "|", "of", "[x]"]
+
+
+def test_encode_iterable_chunk_boundaries():
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH,
+        merges_path=MERGES_PATH,
+        special_tokens=["<|endoftext|>", "<|endoftext|><|endoftext|>"],
+    )
+    with open(FIXTURES_PATH / "tinystories_sample.txt") as f:
+        corpus_contents = f.read()
+    test_string = corpus_contents + "Héllò  hôw're   you?<|endoftext|><|endoftext|>  🙃<|endof<|endoftext|>\n\n"
+    expected = tokenizer.encode(test_string)
+    # Chunk sizes that cut through words, whitespace runs, contractions and special tokens.
+    for size in (1, 2, 3, 5, 13, 1000):
+        chunks = [test_string[i : i + size] for i in range(0, len(test_string), size)]
+        assert list(tokenizer.encode_iterable(chunks)) == expected
+
+
+def test_encode_corpus_to_memmap(tmp_path):
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH,
+        merges_path=MERGES_PATH,
+        special_tokens=["<|endoftext|>"],
+    )
+    input_path = FIXTURES_PATH / "tinystories_sample.txt"
+    with open(input_path) as f:
+        expected = tokenizer.encode(f.read())
+    output_path = tmp_path / "tokens.bin"
+    num_tokens, doc_offsets = encode_corpus(
+        str(input_path), tokenizer, str(output_path), num_workers=2, shard_bytes=1024
+    )
+
+    ids = np.memmap(output_path, dtype=np.uint16, mode="r")
+    assert num_tokens == len(ids) == len(expected)
+    assert ids.tolist() == expected
+    assert np.array_equal(np.load(f"{output_path}.doc_offsets.npy"), doc_offsets)
+    eot_id = tokenizer.byte2id[b"<|endoftext|>"]
+    assert doc_offsets[0] == 0 and doc_offsets[-1] == num_tokens
+    assert len(doc_offsets) - 1 == expected.count(eot_id) + (expected[-1] != eot_id)
+    assert all(ids[end - 1] == eot_id for end in doc_offsets[1:-1])
+
+
+def test_encode_corpus_splits_long_documents(tmp_path):
+    # "Once upon" contains a space, so shard cuts must avoid landing inside it.
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH,
+        merges_path=MERGES_PATH,
+        special_tokens=["<|endoftext|>", "Once upon"],
+    )
+    with open(FIXTURES_PATH / "tinystories_sample.txt") as f:
+        text = f.read().replace("<|endoftext|>", "\n")
+    input_path = tmp_path / "one_document.txt"
+    input_path.write_text(text)
+    output_path = tmp_path / "tokens.bin"
+    num_tokens, _ = encode_corpus(str(input_path), tokenizer, str(output_path), num_workers=2, shard_bytes=64)
+    assert np.memmap(output_path, dtype=np.uint16, mode="r").tolist() == tokenizer.encode(text)
+
+    plain = get_tokenizer_from_vocab_merges_path(vocab_path=VOCAB_PATH, merges_path=MERGES_PATH)
+    with pytest.raises(ValueError):
+        encode_corpus(str(input_path), plain, str(output_path))
+
+
+def test_merge_strategies_match():
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH,
+        merges_path=MERGES_PATH,
+        special_tokens=["<|endoftext|>"],
+    )
+    test_string = ""
+    for name in ("german.txt", "tinystories_sample.txt", "address.txt"):
+        with open(FIXTURES_PATH / name) as f:
+            test_string += f.read()
+    test_string += " " * 300 + "QmFzZTY0IGVuY29kZWQgYmxvYnMgbWFrZSB2ZXJ5IGxvbmcgcHJlLXRva2Vucw==" * 4
+    expected = tokenizer.encode(test_string)
+    # 0 always uses the heap merge, a huge cutoff always the scan merge.
+    for cutoff in (0, 10**9):
+        tokenizer.merge_cutoff = cutoff
+        tokenizer.cache.clear()
+        assert tokenizer.encode(test_string) == expected
+    assert tokenizer.calibrate_merge_cutoff(lengths=(4, 64, 512), samples=2) in (4, 64, 512, 513)
+
+
+def test_decode_stream_holds_back_partial_characters():
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH,
+        merges_path=MERGES_PATH,
+    )
+    test_string = "Héllò hôw are ü? 🙃 日本語"
+    ids = tokenizer.encode(test_string)
+    stream = tokenizer.decode_stream()
+    pieces = [stream.push(i) for i in ids]
+    assert "".join(pieces) + stream.flush() == test_string
+    # Some characters span several tokens; no piece may contain a replacement character.
+    assert "" in pieces
+    assert all("�" not in piece for piece in pieces)
+    assert "".join(tokenizer.decode_iterable(ids)) == test_string
+
+    # Invalid or truncated UTF-8 decodes exactly as decode() does.
+    broken = [tokenizer.byte2id[b"\xf0"], tokenizer.byte2id[b"a"], tokenizer.byte2id[b"\xe6"]]
+    assert "".join(tokenizer.decode_iterable(broken)) == tokenizer.decode(broken)
+
+
+def test_decode_array(tmp_path):
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH,
+        merges_path=MERGES_PATH,
+        special_tokens=["<|endoftext|>"],
+    )
+    with open(FIXTURES_PATH / "tinystories_sample.txt") as f:
+        corpus_contents = f.read()
+    ids = np.array(tokenizer.encode(corpus_contents + "Héllò 🙃"), dtype=np.uint16)
+    assert tokenizer.decode_array(ids) == tokenizer.decode(ids.tolist())
+    assert tokenizer.decode_array(ids, slice_tokens=7) == tokenizer.decode(ids.tolist())
+    assert tokenizer.decode_array(ids[:0]) == ""
+
+    output_path = tmp_path / "decoded.txt"
+    written = tokenizer.decode_to_file(ids, output_path, slice_tokens=100)
+    assert output_path.read_bytes() == b"".join(tokenizer.vocab[i] for i in ids.tolist())
+    assert written == output_path.stat().st_size
+
+    with pytest.raises(KeyError):
+        tokenizer.decode_array(np.array([1, len(tokenizer.vocab) + 5]))
+
+
+def test_count_tokens_and_max_tokens():
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH,
+        merges_path=MERGES_PATH,
+        special_tokens=["<|endoftext|>", "<|endoftext|><|endoftext|>"],
+    )
+    with open(FIXTURES_PATH / "tinystories_sample.txt") as f:
+        corpus_contents = f.read()
+    test_string = corpus_contents + "Héllò  hôw<|endoftext|><|endoftext|> 🙃\n\n"
+    ids = tokenizer.encode(test_string)
+    assert tokenizer.count_tokens(test_string) == len(ids)
+    assert tokenizer.count_tokens("") == 0
+    for max_tokens in (0, 1, 2, 17, 185, 186, 187, len(ids) - 1, len(ids), len(ids) + 10):
+        assert tokenizer.encode(test_string, max_tokens=max_tokens) == ids[:max_tokens]
+
+
+def test_encode_to_array():
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH,
+        merges_path=MERGES_PATH,
+        special_tokens=["<|endoftext|>"],
+    )
+    with open(FIXTURES_PATH / "tinystories_sample.txt") as f:
+        corpus_contents = f.read()
+    ids = tokenizer.encode(corpus_contents)
+
+    array_ids = tokenizer.encode_to_array(corpus_contents)
+    assert array_ids.dtype == np.uint16
+    assert array_ids.tolist() == ids
+    # One document longer than a block, matched lazily.
+    single_document = corpus_contents.replace("<|endoftext|>", " ") * 24
+    assert tokenizer.encode_to_array(single_document, dtype=np.uint32).tolist() == tokenizer.encode(single_document)
+
+    chunks = [corpus_contents[i : i + 37] for i in range(0, len(corpus_contents), 37)]
+    iterable_ids = tokenizer.encode_iterable_to_array(chunks, dtype=np.int32)
+    assert iterable_ids.dtype == np.int32
+    assert iterable_ids.tolist() == ids
+
+    with pytest.raises(ValueError):
+        tokenizer.encode_to_array(corpus_contents, dtype=np.int8)
+    with pytest.raises(ValueError):
+        tokenizer.encode_iterable_to_array(chunks, dtype=np.uint8)
+    with pytest.raises(ValueError):
+        tokenizer.encode_to_array(corpus_contents, dtype=np.float32)
+
+
+def test_artifact_tokenizer_pickles_as_handle(tmp_path):
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH,
+        merges_path=MERGES_PATH,
+        special_tokens=["<|endoftext|>"],
+    )
+    artifact_path = tmp_path / "gpt2.bpetok"
+    tokenizer.save(artifact_path)
+    loaded = type(tokenizer).from_artifact(artifact_path)
+
+    data = pickle.dumps(loaded)
+    assert len(data) < 1024
+    attached = pickle.loads(data)
+    test_string = "Héllò hôw <|endoftext|> are ü? 🙃"
+    ids = tokenizer.encode(test_string)
+    assert attached.encode(test_string) == ids
+    assert attached.decode_array(np.array(ids)) == attached.decode(ids) == test_string
+    assert "".join(attached.decode_iterable(ids)) == test_string
+    # Decoding reads the mapped vocab blob rather than building a per-process vocab dict.
+    assert "vocab" not in attached.__dict__
+    with pytest.raises(KeyError):
+        attached.decode([len(tokenizer.vocab) + 5])
+    with pytest.raises(KeyError):
+        attached.decode_stream().push(-1)
+    assert attached.merge_ids == tokenizer.merge_ids
+    assert attached.byte2id == tokenizer.byte2id
+    assert attached.merge_rank == tokenizer.merge_rank
+
+    # A handle must not silently attach to a different file at the same path.
+    tokenizer.save(artifact_path)
+    with pytest.raises(ValueError):
+        pickle.loads(data)
@@ -1,6 +1,24 @@
 import json
+import random
 import time
 
+import collections
+
+import pytest
+import regex
+
+from cs336_basics.train_bpe import (
+    GPT2_SPLIT_PATTERN,
+    BoundedCounter,
+    PAIR_SHIFT,
+    _PairQueue,
+    _SymbolOrder,
+    _WordShard,
+    pretokenize,
+    pretokenize_shards,
+    read_chunks,
+)
+
 from .adapters import run_train_bpe
 from .common import FIXTURES_PATH, gpt2_bytes_to_unicode
 
@@ -62,6 +80,390 @@ def test_train_bpe():
     assert set(vocab.values()) == set(reference_vocab.values())
 
 
+def test_train_bpe_num_workers_matches_serial():
+    input_path = FIXTURES_PATH / "tinystories_sample.txt"
+    serial_vocab, serial_merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=400,
+        special_tokens=["<|endoftext|>"],
+    )
+    vocab, merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=400,
+        special_tokens=["<|endoftext|>"],
+        num_workers=4,
+    )
+    assert merges == serial_merges
+    assert vocab == serial_vocab
+
+
+def test_train_bpe_merge_workers_match_serial():
+    input_path = FIXTURES_PATH / "corpus.en"
+    serial_vocab, serial_merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+    )
+    warm_start = serial_merges[:100]
+    vocab, merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        initial_merges=warm_start,
+        merge_workers=3,
+    )
+    assert merges == serial_merges
+    assert vocab == serial_vocab
+
+
+def test_train_bpe_engines_match():
+    input_path = FIXTURES_PATH / "tinystories_sample.txt"
+    ids_vocab, ids_merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=600,
+        special_tokens=["<|endoftext|>"],
+        engine="ids",
+    )
+    bytes_vocab, bytes_merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=600,
+        special_tokens=["<|endoftext|>"],
+        engine="bytes",
+    )
+    assert ids_merges == bytes_merges
+    assert ids_vocab == bytes_vocab
+
+
+def test_train_bpe_word_count_cache(tmp_path):
+    input_path = FIXTURES_PATH / "corpus.en"
+    reference = run_train_bpe(input_path=input_path, vocab_size=500, special_tokens=["<|endoftext|>"])
+
+    first = run_train_bpe(
+        input_path=input_path, vocab_size=500, special_tokens=["<|endoftext|>"], cache_dir=str(tmp_path)
+    )
+    assert len(list(tmp_path.iterdir())) == 1
+    second = run_train_bpe(
+        input_path=input_path, vocab_size=500, special_tokens=["<|endoftext|>"], cache_dir=str(tmp_path)
+    )
+    assert first == reference
+    assert second == reference
+
+    # Different special tokens must not reuse the cached table.
+    run_train_bpe(
+        input_path=input_path,
+        vocab_size=300,
+        special_tokens=["<|endoftext|>", "<pad>"],
+        cache_dir=str(tmp_path),
+    )
+    assert len(list(tmp_path.iterdir())) == 2
+
+    # A bounded table keeps reporting its dropped mass when it comes from the cache.
+    bounded = [
+        run_train_bpe(
+            input_path=input_path,
+            vocab_size=300,
+            special_tokens=["<|endoftext|>"],
+            cache_dir=str(tmp_path),
+            max_word_types=100,
+            return_stats=True,
+        )
+        for _ in range(2)
+    ]
+    assert "load_cache" in bounded[1][2].phase_seconds
+    assert bounded[1][2].dropped_count == bounded[0][2].dropped_count > 0
+    assert bounded[1][:2] == bounded[0][:2]
+
+
+def test_train_bpe_sharded_input(tmp_path):
+    input_path = FIXTURES_PATH / "tinystories_sample.txt"
+    reference = run_train_bpe(input_path=input_path, vocab_size=400, special_tokens=["<|endoftext|>"])
+
+    # Split at document boundaries so the shards hold exactly the corpus' pre-tokens.
+    docs = input_path.read_text(encoding="utf-8").split("<|endoftext|>")
+    shard_dir = tmp_path / "shards"
+    shard_dir.mkdir()
+    for k in range(3):
+        (shard_dir / f"part-{k}.txt").write_text("<|endoftext|>".join(docs[k::3]), encoding="utf-8")
+    cache_dir = tmp_path / "cache"
+
+    sharded = run_train_bpe(
+        input_path=str(shard_dir / "part-*.txt"),
+        vocab_size=400,
+        special_tokens=["<|endoftext|>"],
+        cache_dir=str(cache_dir),
+    )
+    assert sharded == reference
+    partials = sorted(cache_dir.iterdir())
+    assert len(partials) == 3
+
+    # A lost partial is recounted on its own; the others are reused as they are.
+    partials[0].unlink()
+    kept = {p: p.stat().st_mtime_ns for p in partials[1:]}
+    again = run_train_bpe(
+        input_path=sorted(shard_dir.iterdir()),
+        vocab_size=400,
+        special_tokens=["<|endoftext|>"],
+        cache_dir=str(cache_dir),
+        num_workers=2,
+    )
+    assert again == reference
+    assert partials[0].exists()
+    assert {p: p.stat().st_mtime_ns for p in partials[1:]} == kept
+
+
+def test_train_bpe_warm_start_matches_cold_start():
+    input_path = FIXTURES_PATH / "corpus.en"
+    vocab, merges = run_train_bpe(input_path=input_path, vocab_size=500, special_tokens=["<|endoftext|>"])
+    _, small_merges = run_train_bpe(input_path=input_path, vocab_size=350, special_tokens=["<|endoftext|>"])
+    assert small_merges == merges[: len(small_merges)]
+
+    warm_vocab, warm_merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        initial_merges=small_merges,
+    )
+    assert warm_merges == merges
+    assert warm_vocab == vocab
+
+
+def test_train_bpe_resumes_from_checkpoint(tmp_path):
+    input_path = FIXTURES_PATH / "corpus.en"
+    checkpoint_path = str(tmp_path / "state.json")
+    reference = run_train_bpe(input_path=input_path, vocab_size=500, special_tokens=["<|endoftext|>"])
+
+    # A run that stops early leaves a checkpoint; the next run picks it up and finishes.
+    run_train_bpe(
+        input_path=input_path,
+        vocab_size=400,
+        special_tokens=["<|endoftext|>"],
+        checkpoint_path=checkpoint_path,
+        checkpoint_every=50,
+    )
+    resumed = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        checkpoint_path=checkpoint_path,
+    )
+    assert resumed == reference
+
+    # Resuming with a smaller vocab uses a prefix of the snapshot but keeps the snapshot whole.
+    smaller = run_train_bpe(
+        input_path=input_path,
+        vocab_size=400,
+        special_tokens=["<|endoftext|>"],
+        checkpoint_path=checkpoint_path,
+    )
+    assert smaller[1] == reference[1][: len(smaller[1])]
+    with open(checkpoint_path, encoding="utf-8") as f:
+        assert len(json.load(f)["merges"]) == len(reference[1])
+
+
+def test_train_bpe_rejects_checkpoint_from_another_run(tmp_path):
+    checkpoint_path = str(tmp_path / "state.json")
+    _, merges = run_train_bpe(
+        input_path=FIXTURES_PATH / "corpus.en",
+        vocab_size=300,
+        special_tokens=["<|endoftext|>"],
+        checkpoint_path=checkpoint_path,
+    )
+    with pytest.raises(ValueError):
+        run_train_bpe(
+            input_path=FIXTURES_PATH / "tinystories_sample.txt",
+            vocab_size=300,
+            special_tokens=["<|endoftext|>"],
+            checkpoint_path=checkpoint_path,
+        )
+    with pytest.raises(ValueError):
+        run_train_bpe(
+            input_path=FIXTURES_PATH / "corpus.en",
+            vocab_size=300,
+            special_tokens=["<|endoftext|>"],
+            checkpoint_path=checkpoint_path,
+            max_word_types=1000,
+        )
+    with pytest.raises(ValueError):
+        run_train_bpe(
+            input_path=FIXTURES_PATH / "corpus.en",
+            vocab_size=300,
+            special_tokens=["<|endoftext|>"],
+            checkpoint_path=checkpoint_path,
+            initial_merges=merges[1::-1],
+        )
+
+
+def test_train_bpe_stats():
+    input_path = FIXTURES_PATH / "corpus.en"
+    progress_calls = []
+    vocab, merges, stats = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        return_stats=True,
+        progress=lambda s: progress_calls.append(s.num_merges),
+    )
+    assert stats.num_merges == len(merges)
+    assert len(stats.words_touched) == len(merges)
+    assert {"read", "pretokenize", "pair_counts", "merge"} <= set(stats.phase_seconds)
+    assert stats.peak_rss > 0
+    assert stats.timeline[-1][1] == (len(merges) // stats.sample_every) * stats.sample_every
+    assert progress_calls and progress_calls[-1] == len(merges)
+
+    # Worker processes are measured too.
+    _, _, pool_stats = run_train_bpe(
+        input_path=input_path,
+        vocab_size=300,
+        special_tokens=["<|endoftext|>"],
+        merge_workers=2,
+        return_stats=True,
+    )
+    assert pool_stats.peak_rss_workers > 0
+
+
+def test_pretokenize_bounded_memory():
+    input_path = str(FIXTURES_PATH / "tinystories_sample.txt")
+    exact = pretokenize(input_path, ["<|endoftext|>"])
+    bounded = pretokenize(input_path, ["<|endoftext|>"], max_word_types=200)
+
+    assert len(bounded) <= 200
+    assert bounded.dropped_count > 0
+    # Nothing is lost without being accounted for, and the most frequent words keep exact counts.
+    assert sum(bounded.values()) + bounded.dropped_count == sum(exact.values())
+    for word, count in exact.most_common(20):
+        assert bounded[word] == count
+
+
+def test_bounded_counter_keeps_dropped_mass_through_counter_operations():
+    counts = BoundedCounter("aaaabbbcc", max_types=4)
+    assert counts.copy() == counts and counts.copy().max_types == 4
+
+    counts.update("defgh")
+    assert len(counts) <= 4 and counts.dropped_count > 0
+    total = sum(counts.values()) + counts.dropped_count
+    combined = counts + BoundedCounter("aaxyz", max_types=4)
+    assert isinstance(combined, BoundedCounter)
+    assert sum(combined.values()) + combined.dropped_count == total + 5
+    counts += collections.Counter("aijkl")
+    assert len(counts) <= 4
+    assert sum(counts.values()) + counts.dropped_count == total + 5
+
+    with pytest.raises(TypeError):
+        counts - collections.Counter("a")
+    with pytest.raises(TypeError):
+        counts.subtract("a")
+    with pytest.raises(TypeError):
+        counts | collections.Counter("a")
+
+def test_pretokenize_shards_keep_dropped_mass(tmp_path):
+    input_path = FIXTURES_PATH / "tinystories_sample.txt"
+    exact = pretokenize(str(input_path), ["<|endoftext|>"])
+    docs = input_path.read_text(encoding="utf-8").split("<|endoftext|>")
+    paths = []
+    for k in range(3):
+        paths.append(str(tmp_path / f"part-{k}.txt"))
+        with open(paths[-1], "w", encoding="utf-8") as f:
+            f.write("<|endoftext|>".join(docs[k::3]))
+
+    shard = pretokenize(paths[0], ["<|endoftext|>"], max_word_types=100)
+    bounded = pretokenize_shards(paths, ["<|endoftext|>"], str(tmp_path / "scratch"), max_word_types=100)
+    # The partial files carry each shard's dropped mass into the reduce.
+    assert bounded.dropped_count >= shard.dropped_count > 0
+    assert sum(bounded.values()) + bounded.dropped_count == sum(exact.values())
+
+
+def test_read_chunks_cuts_only_at_pretoken_boundaries():
+    input_path = FIXTURES_PATH / "tinystories_sample.txt"
+    with open(input_path, encoding="utf-8") as f:
+        contents = f.read()
+    gpt2_pat = regex.compile(GPT2_SPLIT_PATTERN)
+
+    pieces = list(read_chunks(input_path, chunk_size=64, separator=None))
+    assert len(pieces) > 1
+    assert "".join(pieces) == contents
+    piece_counts = collections.Counter()
+    for piece in pieces:
+        piece_counts.update(gpt2_pat.findall(piece))
+    assert piece_counts == collections.Counter(gpt2_pat.findall(contents))
+
+
+def test_read_chunks_does_not_split_special_tokens(tmp_path):
+    # One long document with a special token that contains a space, so cuts could land inside it.
+    words = ["the", "cat", "<pad x>", "sat", "on", "a", "mat."]
+    contents = " ".join(words[i % len(words)] for i in range(560))
+    input_path = tmp_path / "doc.txt"
+    input_path.write_text(contents, encoding="utf-8")
+
+    pieces = list(read_chunks(input_path, chunk_size=50, separator="<|endoftext|>", special_tokens=["<pad x>"]))
+    assert len(pieces) > 1
+    assert "".join(pieces) == contents
+    assert sum(piece.count("<pad x>") for piece in pieces) == contents.count("<pad x>")
+    gpt2_pat = regex.compile(GPT2_SPLIT_PATTERN)
+
+    def count(texts):
+        counts = collections.Counter()
+        for text in texts:
+            for part in text.split("<pad x>"):
+                counts.update(gpt2_pat.findall(part))
+        return counts
+
+    assert count(pieces) == count([contents])
+
+
+def test_word_shard_pair_counts():
+    word_counts = {"hello": 3, " hello": 2, "aaaa": 5, "a": 7, "lol": 1}
+    shard = _WordShard(list(word_counts), list(word_counts.values()))
+    expected = collections.Counter()
+    for word, count in word_counts.items():
+        data = word.encode("utf-8")
+        for left, right in zip(data, data[1:]):
+            expected[(left << PAIR_SHIFT) | right] += count
+    assert dict(shard.pair_counts()) == dict(expected)
+
+    # Merging "l" "l" touches both "hello" words and reports the neighbouring pair deltas.
+    l, e, o = ord("l"), ord("e"), ord("o")
+    deltas, touched = shard.apply_merge(l, l, 300)
+    assert touched == 2
+    assert {pid: d for pid, d in deltas.items() if d} == {
+        (e << PAIR_SHIFT) | l: -5,
+        (e << PAIR_SHIFT) | 300: 5,
+        (l << PAIR_SHIFT) | o: -5,
+        (300 << PAIR_SHIFT) | o: 5,
+    }
+
+
+def test_symbol_order_renumbers_when_a_gap_runs_out():
+    symbols = {i: bytes([i]) for i in range(256)}
+    order = _SymbolOrder(symbols)
+    renumbered = False
+    # Every "a" * k lands between "a" * (k - 1) and "b", halving the same gap each time.
+    for k in range(2, 201):
+        symbols[254 + k] = b"a" * k
+        renumbered |= order.insert(254 + k, b"a" * k)
+    assert renumbered
+    assert sorted(symbols, key=order.label.__getitem__) == sorted(symbols, key=symbols.__getitem__)
+
+
+def test_pair_queue_matches_dict():
+    rng = random.Random(0)
+    reference = {item: rng.randrange(50) for item in range(100)}
+    queue = _PairQueue(dict(reference))
+    for _ in range(5000):
+        item = rng.randrange(150)
+        if rng.random() < 0.3:
+            queue.remove(item)
+            reference.pop(item, None)
+        else:
+            key = rng.randrange(50)
+            queue.set(item, key)
+            reference[item] = key
+        assert len(queue) == len(reference)
+        assert (item in queue) == (item in reference)
+        if reference:
+            top, key = queue.peek()
+            assert key == reference[top] == max(reference.values())
+
+
 def test_train_bpe_special_tokens(snapshot):
     """
     Ensure that the special tokens are added to the vocabulary and not